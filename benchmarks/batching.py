@@ -0,0 +1,69 @@
+"""
+Throughput vs latency of `/explain` inference, with and without the `BatchScheduler`.
+
+  python -m benchmarks.batching --model Bugsplainer --requests 64
+"""
+import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from .utils import load_sbts, percentile
+
+
+def run(explain, sbts, clients: int, num_requests: int):
+  latencies = []
+  lock = threading.Lock()
+
+  def _request(i):
+    started = perf_counter()
+    explain(sbts[i % len(sbts)], num_explanations=3)
+    with lock:
+      latencies.append(perf_counter() - started)
+
+  started = perf_counter()
+  with ThreadPoolExecutor(max_workers=clients) as executor:
+    list(executor.map(_request, range(num_requests)))
+  elapsed = perf_counter() - started
+
+  return {
+    'req/s': num_requests / elapsed,
+    'p50 ms': percentile(latencies, 50) * 1000,
+    'p95 ms': percentile(latencies, 95) * 1000,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--requests', type=int, default=64)
+  parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+  parser.add_argument('--max-batch-size', type=int, default=8)
+  parser.add_argument('--max-wait-ms', type=float, default=10)
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import model_registry
+  from server.BatchScheduler import BatchScheduler
+
+  bugsplainer = model_registry.get(args.model).bugsplainer
+  # both modes explain the same SBTs, so the second would decode the encoder outputs cached by the first
+  bugsplainer.encoder_cache.clear()
+  bugsplainer.encoder_cache.max_size = 0
+  scheduler = BatchScheduler(
+    bugsplainer, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+  )
+  sbts = load_sbts(args.requests)
+
+  print(f'{"mode":<10}{"clients":>8}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}')
+  for clients in args.clients:
+    for mode, explain in (('unbatched', bugsplainer.explain), ('batched', scheduler.explain)):
+      result = run(explain, sbts, clients, args.requests)
+      print(f'{mode:<10}{clients:>8}{result["req/s"]:>10.2f}{result["p50 ms"]:>10.1f}{result["p95 ms"]:>10.1f}')
+
+  scheduler.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+"""
+Latency of the `/experimental/*` endpoints when reading the CSV on every request,
+as they used to, and with the indexed `ExperimentalDataset`. With `--mapped`, also
+compares load time and resident memory of the CSV and the memory-mapped file.
+
+  python -m benchmarks.dataset --requests 20 --mapped data/test-sbt-random-finetune.bspx
+"""
+import argparse
+import json
+import subprocess
+import sys
+from time import perf_counter
+
+import pandas as pd
+
+from .utils import TEST_CSV, percentile, current_rss
+
+
+def legacy_files(csv_path):
+  df: pd.DataFrame = pd.read_csv(csv_path, usecols=['repo', 'path'])
+  filenames: pd.Series = df['repo'].str.replace('.', '/', regex=False) + '/' + df['path']
+  filenames = filenames[filenames.str.len() < 50]
+  return filenames[-100:].sort_values().tolist()
+
+
+def legacy_file(csv_path, filename):
+  df: pd.DataFrame = pd.read_csv(
+    csv_path, usecols=['repo', 'path', 'commit_message', 'content', 'start', 'end'],
+  )
+  filename_parts = filename.split('/')
+  repo = '.'.join(filename_parts[:2])
+  path = '/'.join(filename_parts[2:])
+  df = df[(df['repo'] == repo) & (df['path'] == path)]
+  return dict(
+    content=df.iloc[0]['content'],
+    start=df['start'].tolist(),
+    end=df['end'].tolist(),
+    commit_message=df['commit_message'].tolist(),
+  )
+
+
+def measure(func, *args, repeat: int):
+  latencies = []
+  for _ in range(repeat):
+    started = perf_counter()
+    func(*args)
+    latencies.append(perf_counter() - started)
+  return percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000
+
+
+def measure_load(path):
+  """Load time and memory of a dataset, measured in a fresh process by `--load-only`."""
+  output = subprocess.run(
+    [sys.executable, '-m', 'benchmarks.dataset', '--load-only', path],
+    check=True, capture_output=True, text=True,
+  ).stdout
+  return json.loads(output.splitlines()[-1])
+
+
+def load_only(path):
+  from server.ExperimentalDataset import open_experimental_dataset
+
+  rss_before = current_rss()
+  started = perf_counter()
+  dataset = open_experimental_dataset(path)
+  dataset.get(dataset.filenames()[0])
+  print(json.dumps({
+    'load ms': (perf_counter() - started) * 1000,
+    'rss MB': (current_rss() - rss_before) / 1024 ** 2,
+  }))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--requests', type=int, default=20)
+  parser.add_argument('--csv', default=TEST_CSV)
+  parser.add_argument('--mapped')
+  parser.add_argument('--load-only')
+  args = parser.parse_args()
+
+  if args.load_only:
+    load_only(args.load_only)
+    return
+
+  from server.ExperimentalDataset import ExperimentalDataset
+
+  dataset = ExperimentalDataset(args.csv)
+  started = perf_counter()
+  filename = dataset.filenames()[0]
+  print(f'first load of the dataset: {(perf_counter() - started) * 1000:.1f} ms')
+
+  print(f'{"endpoint":<20}{"implementation":>16}{"p50 ms":>10}{"p95 ms":>10}')
+  for endpoint, legacy, indexed in (
+      ('/experimental/files', (legacy_files, args.csv), (dataset.filenames,)),
+      ('/experimental/file', (legacy_file, args.csv, filename), (dataset.get, filename)),
+  ):
+    for implementation, call in (('csv', legacy), ('indexed', indexed)):
+      p50, p95 = measure(*call, repeat=args.requests)
+      print(f'{endpoint:<20}{implementation:>16}{p50:>10.2f}{p95:>10.2f}')
+
+  if args.mapped:
+    print(f'\n{"format":<8}{"load ms":>10}{"rss MB":>10}')
+    for label, path in (('csv', args.csv), ('mapped', args.mapped)):
+      result = measure_load(path)
+      print(f'{label:<8}{result["load ms"]:>10.1f}{result["rss MB"]:>10.1f}')
+
+
+if __name__ == '__main__':
+  main()
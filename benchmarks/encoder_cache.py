@@ -0,0 +1,68 @@
+"""
+Time to explain the same spans again with a different `num_explanations`, encoding
+them every time, and with the encoder outputs reused from the encoder cache.
+Also reports how many explanations differ between the two.
+
+  python -m benchmarks.encoder_cache --model Bugsplainer --spans 50
+"""
+import argparse
+import os
+from dataclasses import asdict
+from time import perf_counter
+
+from .utils import load_sbts, percentile
+
+NUM_EXPLANATIONS = (1, 3, 5, 10)
+
+
+def explain_all(bugsplainer, sbts):
+  latencies = {num_explanations: [] for num_explanations in NUM_EXPLANATIONS}
+  explanations = []
+  for sbt in sbts:
+    for num_explanations in NUM_EXPLANATIONS:
+      started = perf_counter()
+      explanations.append(bugsplainer.explain(sbt, num_explanations=num_explanations).explanations)
+      latencies[num_explanations].append(perf_counter() - started)
+  return latencies, explanations
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--spans', type=int, default=50)
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import create_model_from_data, model_names
+
+  model_data = next(data for data in asdict(model_names).values() if data['name'] == args.model)
+  bugsplainer = create_model_from_data(model_data)
+  sbts = load_sbts(args.spans)
+  encoder_cache_size = max(bugsplainer.encoder_cache.max_size, len(sbts))
+
+  # warm up, so that the first mode does not pay for it
+  bugsplainer.explain(sbts[0], num_explanations=1)
+
+  results = {}
+  for mode, cache_size in (('no cache', 0), ('cached', encoder_cache_size)):
+    bugsplainer.encoder_cache.clear()
+    bugsplainer.encoder_cache.max_size = cache_size
+    results[mode] = explain_all(bugsplainer, sbts)
+
+  print(f'{len(sbts)} spans, explained with num_explanations of {", ".join(map(str, NUM_EXPLANATIONS))} in turn')
+  print(f'{"num_explanations":<18}{"mode":>10}{"p50 ms":>10}{"total s":>10}')
+  for num_explanations in NUM_EXPLANATIONS:
+    for mode, (latencies, _) in results.items():
+      print(
+        f'{num_explanations:<18}{mode:>10}{percentile(latencies[num_explanations], 50) * 1000:>10.1f}'
+        f'{sum(latencies[num_explanations]):>10.2f}'
+      )
+  print('cache:', bugsplainer.encoder_cache.stats())
+  num_different = sum(
+    cached != uncached for cached, uncached in zip(results['cached'][1], results['no cache'][1])
+  )
+  print(f'different explanations: {num_different} of {len(results["cached"][1])}')
+
+
+if __name__ == '__main__':
+  main()
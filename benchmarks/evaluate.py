@@ -0,0 +1,165 @@
+"""
+Offline evaluation of a model on the test set: BLEU of the top explanation against the
+commit message, throughput, latency of each batch, tokens per second and peak memory.
+The CSV is read in chunks, so the whole test set never sits in memory, and can be
+subsampled. The results are saved as JSON, to compare runs over time.
+
+  python -m benchmarks.evaluate --model Bugsplainer --sample 0.1 --batch-size 8
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+from dataclasses import asdict
+from datetime import datetime
+from time import perf_counter
+from typing import Iterator, List, Tuple
+
+import pandas as pd
+
+from .utils import TEST_CSV, percentile, peak_rss, sentence_bleu
+
+
+def read_spans(csv_path: str, chunk_size: int, sample: float, limit: int, seed: int) -> Iterator[Tuple]:
+  """(content, start, end, commit_message) of the spans of the test set, keeping each with probability `sample`."""
+  rng = random.Random(seed)
+  num_spans = 0
+  chunks = pd.read_csv(csv_path, usecols=['content', 'start', 'end', 'commit_message'], chunksize=chunk_size)
+  for chunk in chunks:
+    for span in chunk.itertuples(index=False):
+      if sample < 1 and rng.random() >= sample:
+        continue
+      if limit and num_spans >= limit:
+        return
+      num_spans += 1
+      yield span.content, span.start, span.end, span.commit_message
+
+
+def make_batches(spans: Iterator[Tuple], batch_size: int, sbt_seconds: List[float], skipped: List[int]):
+  """Batches of (sbts, commit messages). Spans whose file does not parse are counted in `skipped`."""
+  from server import _get_sbt_max_tokens
+  from server.Bugsplainer import Bugsplainer
+
+  # the model is evaluated on the SBTs the server would give it
+  max_tokens = _get_sbt_max_tokens()
+  sbts, commit_messages = [], []
+  for content, start, end, commit_message in spans:
+    started = perf_counter()
+    try:
+      sbt = Bugsplainer.make_sbt_from_span(content, start, end, max_tokens)
+    except SyntaxError:
+      skipped[0] += 1
+      continue
+    finally:
+      sbt_seconds.append(perf_counter() - started)
+    sbts.append(sbt)
+    commit_messages.append(commit_message)
+    if len(sbts) == batch_size:
+      yield sbts, commit_messages
+      sbts, commit_messages = [], []
+  if sbts:
+    yield sbts, commit_messages
+
+
+def git_commit():
+  try:
+    return subprocess.run(
+      ['git', 'rev-parse', 'HEAD'], check=True, capture_output=True, text=True,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--profile', default=None, help='decoding profile, the default one if not set')
+  parser.add_argument('--csv', default=TEST_CSV)
+  parser.add_argument('--chunk-size', type=int, default=256, help='rows of the CSV read at a time')
+  parser.add_argument('--batch-size', type=int, default=8)
+  parser.add_argument('--sample', type=float, default=1., help='fraction of the spans to evaluate')
+  parser.add_argument('--limit', type=int, default=0, help='evaluate at most this many spans')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--device', default='cpu')
+  parser.add_argument('--threads', type=int, default=None)
+  parser.add_argument('--output', default=None, help='defaults to data/evaluations/<time>.json')
+  args = parser.parse_args()
+
+  # only the evaluated model is loaded, rather than warming up the server's
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import create_model_from_data, model_names
+  from server.Bugsplainer import DECODING_PROFILES, DEFAULT_PROFILE
+  from server.InferenceBackend import BackendConfig
+
+  if args.model == model_names.FineTunedCodeT5.name:
+    parser.error(f'{args.model} explains code rather than SBTs')
+  model_data = next(data for data in asdict(model_names).values() if data['name'] == args.model)
+  profile_name = args.profile or DEFAULT_PROFILE
+  profile = DECODING_PROFILES[profile_name]
+
+  loading = perf_counter()
+  bugsplainer = create_model_from_data(model_data, BackendConfig(device=args.device, num_threads=args.threads))
+  load_seconds = perf_counter() - loading
+
+  spans = read_spans(args.csv, args.chunk_size, args.sample, args.limit, args.seed)
+  sbt_seconds, skipped = [], [0]
+  batch_seconds, bleus = [], []
+  input_tokens = output_tokens = 0
+  warmed_up = False
+  for sbts, commit_messages in make_batches(spans, args.batch_size, sbt_seconds, skipped):
+    if not warmed_up:
+      # so that the first batch does not pay for it
+      bugsplainer.explain(sbts[0], num_explanations=1, profile=profile)
+      # nor finds the encoder outputs of its first input cached
+      bugsplainer.encoder_cache.clear()
+      warmed_up = True
+
+    started = perf_counter()
+    explanations = bugsplainer.explain_batch(sbts, [1] * len(sbts), profile=profile)
+    batch_seconds.append(perf_counter() - started)
+
+    input_tokens += sum(bugsplainer.count_tokens(sbt) for sbt in sbts)
+    for explanation, commit_message in zip(explanations, commit_messages):
+      [top] = explanation.explanations[:1] or ['']
+      bleus.append(sentence_bleu(commit_message, top))
+      output_tokens += len(bugsplainer.tokenizer.tokenize(top))
+
+  num_spans = len(bleus)
+  assert num_spans, 'no span was evaluated'
+  generate_seconds = sum(batch_seconds)
+  results = {
+    'created': datetime.now().isoformat(timespec='seconds'),
+    'commit': git_commit(),
+    'model': args.model,
+    'profile': profile_name,
+    'config': {
+      key: getattr(args, key) for key in ('csv', 'batch_size', 'sample', 'limit', 'seed', 'device', 'threads')
+    },
+    'spans': num_spans,
+    'skipped spans': skipped[0],
+    'bleu': 100 * sum(bleus) / num_spans,
+    'spans/s': num_spans / generate_seconds,
+    'batch p50 ms': percentile(batch_seconds, 50) * 1000,
+    'batch p95 ms': percentile(batch_seconds, 95) * 1000,
+    'batch p99 ms': percentile(batch_seconds, 99) * 1000,
+    'input tokens/s': input_tokens / generate_seconds,
+    'output tokens/s': output_tokens / generate_seconds,
+    'sbt p50 ms': percentile(sbt_seconds, 50) * 1000,
+    'load s': load_seconds,
+    'peak rss MB': peak_rss() / 1024 ** 2,
+  }
+
+  for key, value in results.items():
+    if key != 'config':
+      print(f'{key:<18}{value:.2f}' if isinstance(value, float) else f'{key:<18}{value}')
+
+  output = args.output or os.path.join('data', 'evaluations', f'{datetime.now():%Y%m%d-%H%M%S}.json')
+  os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+  with open(output, 'w') as output_file:
+    json.dump(results, output_file, indent=2)
+  print(f'saved to {output}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+"""
+Time to find the intersecting nodes of many hunks in large files, by scanning the
+top-level statements for every hunk, as before, and with the bisected statement index.
+
+  python -m benchmarks.intersection --files 20 --hunks 50
+"""
+import argparse
+import random
+from time import perf_counter
+
+import pandas as pd
+
+from .utils import TEST_CSV
+
+
+def scan(tree, ranges):
+  from server.StructureSuperimposer import StructureSuperImposer
+
+  return [
+    [
+      StructureSuperImposer._get_intersecting_nodes(child, start, end)
+      for child in tree.body
+      if StructureSuperImposer._has_intersection(child, start, end)
+    ]
+    for start, end in ranges
+  ]
+
+
+def bisect(tree, ranges):
+  from server.StructureSuperimposer import StructureSuperImposer
+
+  return [
+    [
+      StructureSuperImposer._get_intersecting_nodes(child, start, end)
+      for child in StructureSuperImposer._get_intersecting_statements(tree, start, end)
+    ]
+    for start, end in ranges
+  ]
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--files', type=int, default=20)
+  parser.add_argument('--hunks', type=int, default=50)
+  args = parser.parse_args()
+
+  from server.StructureSuperimposer import StructureSuperImposer
+
+  contents = pd.read_csv(TEST_CSV, usecols=['content'])['content'].unique()
+  # the largest files
+  contents = sorted(contents, key=len, reverse=True)
+  random.seed(0)
+  workloads = []
+  for content in contents:
+    if len(workloads) == args.files:
+      break
+    try:
+      tree = StructureSuperImposer.parse_ast_with_async_await_check(content)
+    except SyntaxError:
+      continue
+    num_lines = content.count('\n') + 1
+    starts = sorted(random.randint(1, num_lines) for _ in range(args.hunks))
+    workloads.append((tree, [(start, start + random.randint(0, 10)) for start in starts]))
+
+  results = {}
+  for label, find in (('scan', scan), ('bisect', bisect)):
+    started = perf_counter()
+    outputs = [find(tree, ranges) for tree, ranges in workloads]
+    results[label] = perf_counter() - started, [
+      StructureSuperImposer.get_bracketed_notation_of(nodes, 0)
+      for output in outputs for nodes in output
+    ]
+
+  print(f'{len(workloads)} files, {args.hunks} hunks each')
+  for label, (elapsed, _) in results.items():
+    print(f'{label:<8}{elapsed * 1000:>10.1f} ms')
+  print('identical:', results['scan'][1] == results['bisect'][1])
+
+
+if __name__ == '__main__':
+  main()
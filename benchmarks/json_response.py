@@ -0,0 +1,92 @@
+"""
+Per-response overhead of serializing a large `/experimental/file` payload: encoding it,
+parsing it back and encoding it again with the request id, as `send_req_ids` used to,
+and encoding it once with the id by `server.JsonResponse.jsonify`, with the json module
+and with orjson if it is installed.
+
+  python -m benchmarks.json_response --files 5 --repeat 50
+"""
+import argparse
+import json
+import os
+from time import perf_counter, time
+
+import flask
+
+from .utils import TEST_CSV, load_spans, percentile
+
+
+def legacy_response(payload):
+  response = flask.jsonify(payload)
+  response.data = json.dumps({
+    **(response.json if response.json else {}),
+    'id': str(flask.request.environ['id']),
+    'created': flask.request.environ['created'],
+    'completed': time(),
+  })
+  return response
+
+
+def make_payloads(num_files: int, csv_path: str):
+  """`/experimental/file` payloads of the largest files among the first spans of the test set."""
+  spans = load_spans(2000, csv_path)
+  payloads = []
+  for content, file_spans in spans.groupby('content', sort=False):
+    payloads.append(dict(
+      content=content,
+      start=file_spans['start'].tolist(),
+      end=file_spans['end'].tolist(),
+      commit_message=file_spans['commit_message'].tolist(),
+    ))
+  return sorted(payloads, key=lambda payload: -len(payload['content']))[:num_files]
+
+
+def time_responses(app, make_response, payloads, repeat: int):
+  latencies = []
+  with app.test_request_context():
+    flask.request.environ['id'], flask.request.environ['created'] = 'benchmark', time()
+    for _ in range(repeat):
+      for payload in payloads:
+        started = perf_counter()
+        make_response(payload).get_data()
+        latencies.append(perf_counter() - started)
+  return latencies
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--files', type=int, default=5)
+  parser.add_argument('--repeat', type=int, default=50)
+  parser.add_argument('--csv', default=TEST_CSV)
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import app, JsonResponse
+
+  payloads = make_payloads(args.files, args.csv)
+  sizes = [len(JsonResponse.dumps(payload)) for payload in payloads]
+  print(f'{len(payloads)} files, {sum(sizes) / len(sizes) / 1024:.0f} KB per response on average')
+
+  orjson = JsonResponse.orjson
+  modes = [('parse and re-encode', legacy_response, None), ('encode once, json', JsonResponse.jsonify, None)]
+  if orjson is not None:
+    modes.append(('encode once, orjson', JsonResponse.jsonify, orjson))
+  else:
+    print('orjson is not installed')
+
+  print(f'{"mode":<22}{"p50 ms":>10}{"p95 ms":>10}{"MB/s":>10}')
+  try:
+    for mode, make_response, encoder in modes:
+      JsonResponse.orjson = encoder
+      latencies = time_responses(app, make_response, payloads, args.repeat)
+      throughput = sum(sizes) * args.repeat / sum(latencies) / 1024 ** 2
+      print(
+        f'{mode:<22}{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 95) * 1000:>10.2f}'
+        f'{throughput:>10.1f}'
+      )
+  finally:
+    JsonResponse.orjson = orjson
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,70 @@
+"""
+Per-bucket latency of `Bugsplainer.explain` when padding every input to 512 tokens,
+to its exact length, and to the smallest fitting bucket. Also checks that the
+explanations do not change.
+
+  python -m benchmarks.padding --model Bugsplainer --spans 200
+"""
+import argparse
+import os
+from collections import defaultdict
+from time import perf_counter
+
+from .utils import load_sbts, percentile
+
+BUCKETS = [64, 128, 256, 512]
+MODES = {
+  'max_length': [512],
+  'exact': None,
+  'bucketed': BUCKETS,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--spans', type=int, default=200)
+  parser.add_argument('--per-bucket', type=int, default=10)
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import model_registry
+
+  bugsplainer = model_registry.get(args.model).bugsplainer
+  # each mode explains the same SBTs, which must be encoded again rather than found in the cache
+  bugsplainer.encoder_cache.clear()
+  bugsplainer.encoder_cache.max_size = 0
+  sbts_by_bucket = defaultdict(list)
+  for sbt in load_sbts(args.spans):
+    num_tokens = len(bugsplainer.tokenizer.encode(f"finetune sbt-random: {sbt}"))
+    bucket = min((bucket for bucket in BUCKETS if num_tokens <= bucket), default=BUCKETS[-1])
+    if len(sbts_by_bucket[bucket]) < args.per_bucket:
+      sbts_by_bucket[bucket].append(sbt)
+
+  print(f'{"bucket":>8}{"spans":>7}' + ''.join(f'{mode + " p50 ms":>20}' for mode in MODES) + f'{"identical":>11}')
+  for bucket in BUCKETS:
+    sbts = sbts_by_bucket[bucket]
+    if not sbts:
+      continue
+
+    latencies = {}
+    explanations = {}
+    for mode, padding_buckets in MODES.items():
+      bugsplainer.padding_buckets = padding_buckets
+      latencies[mode] = []
+      explanations[mode] = []
+      for sbt in sbts:
+        started = perf_counter()
+        explanations[mode].append(bugsplainer.explain(sbt, num_explanations=3).explanations)
+        latencies[mode].append(perf_counter() - started)
+
+    identical = all(explanations[mode] == explanations['max_length'] for mode in MODES)
+    print(
+      f'{bucket:>8}{len(sbts):>7}' +
+      ''.join(f'{percentile(latencies[mode], 50) * 1000:>20.1f}' for mode in MODES) +
+      f'{str(identical):>11}'
+    )
+
+
+if __name__ == '__main__':
+  main()
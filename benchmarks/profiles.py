@@ -0,0 +1,79 @@
+"""
+Latency and BLEU of the explanations of every decoding profile, explaining the
+spans of the test set one at a time, as interactive requests do. The report is
+saved for `/models` to serve along with the profiles.
+
+  python -m benchmarks.profiles --model Bugsplainer --spans 100
+"""
+import argparse
+import json
+import os
+from dataclasses import asdict
+from time import perf_counter
+
+from .utils import load_spans, percentile, sentence_bleu
+
+
+def evaluate(bugsplainer, sbts, commit_messages, profile):
+  latencies, bleus, lengths = [], [], []
+  for sbt, commit_message in zip(sbts, commit_messages):
+    started = perf_counter()
+    explanation = bugsplainer.explain(sbt, num_explanations=1, profile=profile).explanations[0]
+    latencies.append(perf_counter() - started)
+    bleus.append(sentence_bleu(commit_message, explanation))
+    lengths.append(len(explanation.split()))
+
+  return {
+    'p50 ms': percentile(latencies, 50) * 1000,
+    'p95 ms': percentile(latencies, 95) * 1000,
+    'bleu': 100 * sum(bleus) / max(len(bleus), 1),
+    'mean words': sum(lengths) / max(len(lengths), 1),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--spans', type=int, default=100)
+  parser.add_argument('--output', default='data/decoding-profiles.json')
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import _get_sbt_max_tokens, create_model_from_data, model_names
+  from server.Bugsplainer import Bugsplainer, DECODING_PROFILES
+
+  model_data = next(data for data in asdict(model_names).values() if data['name'] == args.model)
+  bugsplainer = create_model_from_data(model_data)
+  # each profile explains the same SBTs, which must be encoded again rather than found in the cache
+  bugsplainer.encoder_cache.max_size = 0
+
+  max_tokens = _get_sbt_max_tokens()
+  sbts, commit_messages = [], []
+  for span in load_spans(args.spans).itertuples():
+    try:
+      sbts.append(Bugsplainer.make_sbt_from_span(span.content, span.start, span.end, max_tokens))
+    except SyntaxError:
+      continue
+    commit_messages.append(span.commit_message)
+
+  # warm up, so that the first profile does not pay for it
+  bugsplainer.explain(sbts[0], num_explanations=1)
+
+  report = {
+    name: evaluate(bugsplainer, sbts, commit_messages, profile)
+    for name, profile in DECODING_PROFILES.items()
+  }
+
+  print(f'{"profile":<10}{"p50 ms":>10}{"p95 ms":>10}{"bleu":>8}{"words":>8}')
+  for name, result in report.items():
+    print(
+      f'{name:<10}{result["p50 ms"]:>10.1f}{result["p95 ms"]:>10.1f}'
+      f'{result["bleu"]:>8.2f}{result["mean words"]:>8.1f}'
+    )
+
+  with open(args.output, 'w') as output:
+    json.dump({'model': args.model, 'spans': len(sbts), 'profiles': report}, output, indent=2)
+
+
+if __name__ == '__main__':
+  main()
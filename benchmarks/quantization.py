@@ -0,0 +1,100 @@
+"""
+Compares fp32 and dynamically int8-quantized models on CPU by latency, resident
+memory, and BLEU/exact-match of their explanations against the commit messages.
+Each is measured in a process of its own.
+
+  python -m benchmarks.quantization --model "Bugsplainer 220M" --spans 100
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from dataclasses import asdict
+from time import perf_counter
+from typing import Dict, Optional
+
+from .utils import load_spans, percentile, current_rss, sentence_bleu
+
+MODES = ('fp32', 'int8')
+
+
+def evaluate(bugsplainer, spans):
+  from server import _get_sbt_max_tokens
+  from server.Bugsplainer import Bugsplainer
+
+  max_tokens = _get_sbt_max_tokens()
+  latencies, explanations, bleus, exact_matches = [], [], [], []
+  for span in spans:
+    try:
+      sbt = Bugsplainer.make_sbt_from_span(span.content, span.start, span.end, max_tokens)
+    except SyntaxError:
+      continue
+    started = perf_counter()
+    explanation = bugsplainer.explain(sbt, num_explanations=1).explanations[0]
+    latencies.append(perf_counter() - started)
+    explanations.append(explanation)
+    bleus.append(sentence_bleu(span.commit_message, explanation))
+    exact_matches.append(explanation.strip().lower() == span.commit_message.strip().lower())
+
+  return explanations, {
+    'p50 ms': percentile(latencies, 50) * 1000,
+    'p95 ms': percentile(latencies, 95) * 1000,
+    'bleu': 100 * sum(bleus) / max(len(bleus), 1),
+    'exact match %': 100 * sum(exact_matches) / max(len(exact_matches), 1),
+  }
+
+
+def measure(model: str, mode: str, num_spans: int, num_threads: Optional[int]) -> Dict:
+  """The explanations and measurements of one mode, loading the model into this process."""
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import create_model_from_data, model_names
+  from server.InferenceBackend import BackendConfig
+
+  model_data = next(data for data in asdict(model_names).values() if data['name'] == model)
+  spans = list(load_spans(num_spans).itertuples())
+
+  rss_before = current_rss()
+  bugsplainer = create_model_from_data(
+    model_data, BackendConfig(device='cpu', num_threads=num_threads, int8=mode == 'int8'),
+  )
+  explanations, report = evaluate(bugsplainer, spans)
+  report['rss MB'] = (current_rss() - rss_before) / 1024 ** 2
+  return {'explanations': explanations, 'report': report}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--spans', type=int, default=100)
+  parser.add_argument('--num-threads', type=int)
+  parser.add_argument('--mode', choices=MODES, help='measure only this mode, and print it as JSON')
+  args = parser.parse_args()
+
+  if args.mode:
+    print(json.dumps(measure(args.model, args.mode, args.spans, args.num_threads)))
+    return
+
+  report = {}
+  outputs = {}
+  for mode in MODES:
+    # each mode in a process of its own, so that the memory of one is not counted in the other
+    command = [
+      sys.executable, '-m', 'benchmarks.quantization',
+      '--model', args.model, '--spans', str(args.spans), '--mode', mode,
+    ]
+    if args.num_threads:
+      command.append(f'--num-threads={args.num_threads}')
+    stdout = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    result = json.loads(stdout.splitlines()[-1])
+    outputs[mode], report[mode] = result['explanations'], result['report']
+
+  report['int8']['same as fp32 %'] = 100 * sum(
+    fp32 == int8 for fp32, int8 in zip(outputs['fp32'], outputs['int8'])
+  ) / max(len(outputs['fp32']), 1)
+
+  print(json.dumps({'model': args.model, 'spans': len(outputs['fp32']), **report}, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,47 @@
+"""
+Cold vs warm latency of the FineTuned CodeT5 path. A cold request loads the model,
+as every request did before the model registry.
+
+  python -m benchmarks.registry --requests 10
+"""
+import argparse
+import os
+from time import perf_counter
+
+from .utils import load_spans, percentile
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--requests', type=int, default=10)
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server import model_names, model_registry
+
+  name = model_names.FineTunedCodeT5.name
+  # the code of the spans, as FineTuned CodeT5 reads it
+  codes = [
+    '\n'.join(span.content.splitlines()[span.start - 1: span.end])
+    for span in load_spans(args.requests).itertuples()
+  ]
+
+  cold, warm = [], []
+  for code in codes:
+    model_registry.unload(name)
+    started = perf_counter()
+    model_registry.get(name).explain(code, num_explanations=3)
+    cold.append(perf_counter() - started)
+
+  for code in codes:
+    started = perf_counter()
+    model_registry.get(name).explain(code, num_explanations=3)
+    warm.append(perf_counter() - started)
+
+  print(f'{"":<6}{"p50 ms":>10}{"p95 ms":>10}')
+  for label, latencies in (('cold', cold), ('warm', warm)):
+    print(f'{label:<6}{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 95) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+"""
+Time to serialize whole files of the test set into SBT, with the former recursive
+serializer and the current iterative one. Also checks that their outputs are identical.
+
+  python -m benchmarks.sbt --files 200
+"""
+import argparse
+import ast
+from time import perf_counter
+
+import pandas as pd
+
+from .utils import TEST_CSV
+
+
+def recursive_bracketed_notation_of(nodes, indent, level=0) -> str:
+  """`StructureSuperImposer.get_bracketed_notation_of` before it became iterative."""
+  from server.StructureSuperimposer import _make_indent
+
+  bracketed_notation = ''
+  for node in nodes:
+    if isinstance(node, list):
+      bracketed_notation += recursive_bracketed_notation_of(node, indent, level=level + 1)
+    elif isinstance(node, ast.AST):
+      _fields = filter(lambda field: field != 'ctx', node._fields)
+      children = [node.__getattribute__(field) for field in _fields]
+      children = list(filter(lambda x: x is not None, children))
+      if isinstance(node, ast.Dict):
+        assert len(children) == 2
+        children = [list(pair) for pair in zip(children[0], children[1])]
+      bracketed_notation += _make_indent(level, indent)
+      bracketed_notation += '('
+      bracketed_notation += type(node).__name__
+      bracketed_notation += recursive_bracketed_notation_of(children, indent, level=level + 1)
+      bracketed_notation += ')'
+      bracketed_notation += type(node).__name__
+    else:
+      if bracketed_notation.endswith(')Name'):
+        bracketed_notation = bracketed_notation[:-5]
+      bracketed_notation += f'_{node}'
+
+  return bracketed_notation
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--files', type=int, default=200)
+  args = parser.parse_args()
+
+  from server.StructureSuperimposer import StructureSuperImposer
+
+  contents = pd.read_csv(TEST_CSV, usecols=['content'], nrows=args.files * 10)['content'].unique()
+  trees = []
+  for content in contents[:args.files]:
+    try:
+      superimposer = StructureSuperImposer.from_source_code(content, 1, content.count('\n') + 1)
+    except SyntaxError:
+      continue
+    trees.append(superimposer.source_nodes)
+
+  timings = {}
+  outputs = {}
+  for label, serialize in (
+      ('recursive', recursive_bracketed_notation_of),
+      ('iterative', StructureSuperImposer.get_bracketed_notation_of),
+  ):
+    started = perf_counter()
+    outputs[label] = [serialize(nodes, 0) for nodes in trees]
+    timings[label] = perf_counter() - started
+
+  print(f'{len(trees)} files, {sum(map(len, outputs["iterative"])) / 1024:.0f} KiB of SBT')
+  for label, elapsed in timings.items():
+    print(f'{label:<10}{elapsed * 1000:>10.1f} ms')
+  print(f'speedup: {timings["recursive"] / timings["iterative"]:.2f}x')
+  print('identical:', outputs['recursive'] == outputs['iterative'])
+
+
+if __name__ == '__main__':
+  main()
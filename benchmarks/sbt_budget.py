@@ -0,0 +1,51 @@
+"""
+How many SBTs of the test set do not fit in a model input, how many tokens they
+have, and how long it takes to shrink them to the token budget.
+
+  python -m benchmarks.sbt_budget --spans 500
+"""
+import argparse
+import os
+from time import perf_counter
+
+from .utils import load_spans, percentile
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--spans', type=int, default=500)
+  parser.add_argument('--max-tokens', type=int, default=None, help='defaults to what fits in a model input')
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server.Bugsplainer import count_sbt_tokens, get_sbt_token_budget, to_sbt
+  from server.StructureSuperimposer import StructureSuperImposer
+
+  max_tokens = args.max_tokens or get_sbt_token_budget(512, 'finetune sbt-random: ')
+  full_lengths, over_budget_lengths, fitted_lengths, fit_seconds = [], [], [], []
+  for span in load_spans(args.spans).itertuples():
+    try:
+      structure_superimposer = StructureSuperImposer.from_source_code(span.content, span.start, span.end)
+    except SyntaxError:
+      continue
+    full_length = count_sbt_tokens(to_sbt(structure_superimposer))
+    full_lengths.append(full_length)
+    if full_length <= max_tokens:
+      continue
+    over_budget_lengths.append(full_length)
+
+    started = perf_counter()
+    sbt = to_sbt(structure_superimposer, max_tokens)
+    fit_seconds.append(perf_counter() - started)
+    fitted_lengths.append(count_sbt_tokens(sbt))
+
+  print(f'{len(full_lengths)} spans, budget of {max_tokens} tokens')
+  print(f'over budget: {len(fitted_lengths)} ({100 * len(fitted_lengths) / max(len(full_lengths), 1):.1f}%)')
+  if fitted_lengths:
+    print(f'tokens of the SBTs over budget: p50 {percentile(over_budget_lengths, 50)}, max {max(over_budget_lengths)}')
+    print(f'tokens after fitting: p50 {percentile(fitted_lengths, 50)}, max {max(fitted_lengths)}')
+    print(f'time to fit: p50 {percentile(fit_seconds, 50) * 1000:.1f} ms, p95 {percentile(fit_seconds, 95) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,51 @@
+"""
+Throughput of building the SBTs of the spans of the test set with an `SbtPool`
+of 1, 2, 4 and 8 processes, as the jobs of `/jobs` do.
+
+  python -m benchmarks.sbt_pool --spans 2000
+"""
+import argparse
+import os
+from time import perf_counter
+
+from .utils import load_spans
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--spans', type=int, default=2000)
+  parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  os.environ.setdefault('BUGSPLAINER_WARM_UP', '0')
+  from server.SbtPool import SbtPool
+  from server.StructureSuperimposer import StructureSuperImposer
+
+  # measure parsing too, rather than the parsed tree cache of this process
+  StructureSuperImposer.PARSED_TREE_CACHE_SIZE = 0
+  spans = [(span.content, int(span.start), int(span.end)) for span in load_spans(args.spans).itertuples()]
+  print(f'{len(spans)} spans of {len({code for code, _, _ in spans})} files')
+
+  expected = None
+  print(f'{"processes":<10}{"spans/s":>10}{"speedup":>10}')
+  for num_processes in args.processes:
+    sbt_pool = SbtPool(num_processes)
+    try:
+      sbt_pool.start()
+      elapsed = float('inf')
+      for _ in range(args.repeat):
+        started = perf_counter()
+        sbts = sbt_pool.make_sbts_from_spans(spans)
+        elapsed = min(elapsed, perf_counter() - started)
+    finally:
+      sbt_pool.close()
+
+    if expected is None:
+      expected, baseline = sbts, elapsed
+    assert sbts == expected, f'the SBTs of {num_processes} processes differ'
+    print(f'{num_processes:<10}{len(spans) / elapsed:>10.1f}{baseline / elapsed:>10.2f}')
+
+
+if __name__ == '__main__':
+  main()
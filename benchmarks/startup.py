@@ -0,0 +1,92 @@
+"""
+Startup time of the server: the slowest imports of `server` by `python -X importtime`,
+and the wall-clock time from starting gunicorn to its first `/models` response and
+to `/ready` reporting the warmed up models as loaded.
+
+  python -m benchmarks.startup
+"""
+import argparse
+import os
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+from time import perf_counter, sleep
+
+
+def slowest_imports(top: int):
+  """Cumulative import time in ms of `server`, and of the slowest packages it imports."""
+  stderr = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', 'import server'],
+    env={**os.environ, 'BUGSPLAINER_WARM_UP': '0'}, check=True, capture_output=True, text=True,
+  ).stderr
+
+  cumulative = {}
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or '|' not in line:
+      continue
+    _, cumulative_us, module = line[len('import time:'):].split('|')
+    if not cumulative_us.strip().isdigit():
+      # the header
+      continue
+    # every module is imported once, so report the packages wherever they are nested
+    module = module.strip()
+    if '.' not in module:
+      cumulative[module] = int(cumulative_us) / 1000
+
+  return cumulative.get('server'), sorted(cumulative.items(), key=lambda item: -item[1])[:top]
+
+
+def wait_for_ready(url: str, process: subprocess.Popen, timeout=600):
+  deadline = perf_counter() + timeout
+  while perf_counter() < deadline:
+    assert process.poll() is None, 'gunicorn exited'
+    try:
+      with urllib.request.urlopen(url, timeout=5):
+        return
+    except urllib.error.HTTPError as e:
+      # `/ready` is 503 until the models are loaded
+      assert e.code == 503, e
+    except OSError:
+      pass
+    sleep(.1)
+  raise TimeoutError(url)
+
+
+def time_to_serve(port: int, warm_up: bool):
+  started = perf_counter()
+  gunicorn = subprocess.Popen(
+    [sys.executable, '-m', 'gunicorn', '-w=1', '--timeout=600', f'--bind=127.0.0.1:{port}', 'server:app'],
+    env={**os.environ, 'BUGSPLAINER_WARM_UP': '1' if warm_up else '0'},
+  )
+  try:
+    wait_for_ready(f'http://127.0.0.1:{port}/models', gunicorn)
+    first_response = perf_counter() - started
+    wait_for_ready(f'http://127.0.0.1:{port}/ready', gunicorn)
+    ready = perf_counter() - started
+  finally:
+    gunicorn.terminate()
+    gunicorn.wait()
+  return first_response, ready
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--top', type=int, default=10)
+  parser.add_argument('--port', type=int, default=5056)
+  args = parser.parse_args()
+
+  server_ms, imports = slowest_imports(args.top)
+  print(f'import server: {server_ms:.1f} ms')
+  print(f'{"module":<30}{"cumulative ms":>15}')
+  for module, cumulative_ms in imports:
+    print(f'{module:<30}{cumulative_ms:>15.1f}')
+
+  print(f'\n{"warm-up":<10}{"first /models s":>17}{"ready s":>10}')
+  for warm_up in (False, True):
+    first_response, ready = time_to_serve(args.port, warm_up)
+    print(f'{"on" if warm_up else "off":<10}{first_response:>17.2f}{ready:>10.2f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,73 @@
+import math
+import os
+import resource
+from collections import Counter
+from typing import List, Sequence
+
+import pandas as pd
+
+TEST_CSV = './data/test-sbt-random-finetune.csv'
+
+
+def load_spans(n: int, csv_path=TEST_CSV) -> pd.DataFrame:
+  """Read the first `n` spans of the test set, with the content of their files."""
+  return pd.read_csv(csv_path, usecols=['content', 'start', 'end', 'commit_message'], nrows=n)
+
+
+def load_sbts(n: int, csv_path=TEST_CSV) -> List[str]:
+  from server import _get_sbt_max_tokens
+  from server.Bugsplainer import Bugsplainer
+
+  # shrunk to the same budget as the SBTs of the server
+  max_tokens = _get_sbt_max_tokens()
+  sbts = []
+  for row in load_spans(n, csv_path).itertuples():
+    try:
+      sbts.append(Bugsplainer.make_sbt_from_span(row.content, row.start, row.end, max_tokens))
+    except SyntaxError:
+      continue
+  return sbts
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+  if not values:
+    return math.nan
+  values = sorted(values)
+  k = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+  return values[k]
+
+
+def current_rss() -> int:
+  """Resident memory of this process in bytes."""
+  with open('/proc/self/statm') as statm:
+    return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss() -> int:
+  """Peak resident memory of this process in bytes."""
+  # in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sentence_bleu(reference: str, hypothesis: str, max_n=4) -> float:
+  """Smoothed sentence BLEU, as used to evaluate CodeT5 on commit messages."""
+  reference, hypothesis = reference.lower().split(), hypothesis.lower().split()
+  if not reference or not hypothesis:
+    return 0.
+
+  log_precision = 0.
+  for n in range(1, max_n + 1):
+    hypothesis_ngrams = Counter(tuple(hypothesis[i: i + n]) for i in range(len(hypothesis) - n + 1))
+    reference_ngrams = Counter(tuple(reference[i: i + n]) for i in range(len(reference) - n + 1))
+    matches = sum((hypothesis_ngrams & reference_ngrams).values())
+    total = max(len(hypothesis) - n + 1, 0)
+    if n == 1:
+      if matches == 0:
+        return 0.
+      log_precision += math.log(matches / total) / max_n
+    else:
+      # add-one smoothing of the higher order n-grams
+      log_precision += math.log((matches + 1) / (total + 1)) / max_n
+
+  brevity_penalty = min(1., math.exp(1 - len(reference) / len(hypothesis)))
+  return brevity_penalty * math.exp(log_precision)
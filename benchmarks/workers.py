@@ -0,0 +1,167 @@
+"""
+Memory and throughput of gunicorn with 2, 4 and 8 workers, when every worker loads
+the models, and when the workers share the models of a `server.ModelServer`.
+Memory is reported as RSS and as PSS, which splits shared pages between processes.
+
+  python -m benchmarks.workers --model Bugsplainer --requests 128
+"""
+import argparse
+import ast
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from typing import Dict, List
+
+from .utils import load_spans, percentile
+
+
+def memory_of(pid: int) -> Dict[str, int]:
+  """RSS and PSS of a process in bytes."""
+  memory = {}
+  with open(f'/proc/{pid}/smaps_rollup') as smaps:
+    for line in smaps:
+      field, value, *_ = line.split()
+      if field in ('Rss:', 'Pss:'):
+        memory[field[:-1].lower()] = int(value) * 1024
+  return memory
+
+
+def children_of(pid: int) -> List[int]:
+  with open(f'/proc/{pid}/task/{pid}/children') as children:
+    return [int(child) for child in children.read().split()]
+
+
+def post(url: str, payload: Dict):
+  request = urllib.request.Request(
+    url, data=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'},
+  )
+  with urllib.request.urlopen(request, timeout=600) as response:
+    return json.load(response)
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout=600):
+  deadline = perf_counter() + timeout
+  while perf_counter() < deadline:
+    assert process.poll() is None, 'gunicorn exited'
+    try:
+      with urllib.request.urlopen(url, timeout=5):
+        return
+    except OSError:
+      sleep(1)
+  raise TimeoutError(url)
+
+
+def run(url: str, payloads: List[Dict], clients: int, num_requests: int):
+  latencies = []
+  lock = threading.Lock()
+
+  def _request(i):
+    started = perf_counter()
+    post(url, payloads[i % len(payloads)])
+    with lock:
+      latencies.append(perf_counter() - started)
+
+  started = perf_counter()
+  with ThreadPoolExecutor(max_workers=clients) as executor:
+    list(executor.map(_request, range(num_requests)))
+  elapsed = perf_counter() - started
+  return num_requests / elapsed, percentile(latencies, 50) * 1000
+
+
+def measure(mode: str, num_workers: int, payloads: List[Dict], args) -> Dict:
+  env = {
+    **os.environ,
+    # measure the models rather than the explanation and encoder caches, as the payloads repeat
+    'BUGSPLAINER_EXPLANATION_CACHE_SIZE': '0',
+    'BUGSPLAINER_ENCODER_CACHE_SIZE': '0',
+  }
+  env.pop('BUGSPLAINER_EXPLANATION_CACHE_PATH', None)
+  env.pop('BUGSPLAINER_MODEL_SERVER', None)
+  processes = []
+  try:
+    if mode == 'model server':
+      address = os.path.join(tempfile.mkdtemp(), 'model-server.sock')
+      env['BUGSPLAINER_MODEL_SERVER_AUTHKEY'] = secrets.token_hex(32)
+      model_server = subprocess.Popen([sys.executable, '-m', 'server.ModelServer', address], env=env)
+      processes.append(model_server)
+      while not os.path.exists(address):
+        assert model_server.poll() is None, 'the model server exited'
+        sleep(1)
+      env['BUGSPLAINER_MODEL_SERVER'] = address
+
+    gunicorn = subprocess.Popen(
+      [
+        sys.executable, '-m', 'gunicorn', f'-w={num_workers}', '--threads=8', '--timeout=600',
+        f'--bind=127.0.0.1:{args.port}', 'server:app',
+      ],
+      env=env,
+    )
+    processes.append(gunicorn)
+    base_url = f'http://127.0.0.1:{args.port}'
+    wait_until_ready(f'{base_url}/models', gunicorn)
+    # let every worker load and warm up
+    run(f'{base_url}/explain', payloads, args.clients, num_workers * 4)
+
+    throughput, p50 = run(f'{base_url}/explain', payloads, args.clients, args.requests)
+    workers = children_of(gunicorn.pid)
+    worker_memory = [memory_of(pid) for pid in workers]
+    total = {
+      kind: sum(memory[kind] for memory in worker_memory) + sum(
+        memory_of(process.pid)[kind] for process in processes if process is not gunicorn
+      )
+      for kind in ('rss', 'pss')
+    }
+    return {
+      'req/s': throughput,
+      'p50 ms': p50,
+      'worker rss MB': sum(memory['rss'] for memory in worker_memory) / len(workers) / 1024 ** 2,
+      'total rss MB': total['rss'] / 1024 ** 2,
+      'total pss MB': total['pss'] / 1024 ** 2,
+    }
+  finally:
+    for process in processes:
+      process.terminate()
+      process.wait()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='Bugsplainer')
+  parser.add_argument('--requests', type=int, default=128)
+  parser.add_argument('--clients', type=int, default=32)
+  parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+  parser.add_argument('--port', type=int, default=5055)
+  args = parser.parse_args()
+
+  payloads = []
+  for span in load_spans(args.requests).itertuples():
+    try:
+      ast.parse(span.content)
+    except SyntaxError:
+      continue
+    payloads.append({
+      'code': span.content, 'start': span.start, 'end': span.end, 'model': args.model, 'num_explanations': 3,
+    })
+
+  print(
+    f'{"mode":<14}{"workers":>8}{"req/s":>8}{"p50 ms":>10}'
+    f'{"worker rss MB":>15}{"total rss MB":>14}{"total pss MB":>14}'
+  )
+  for num_workers in args.workers:
+    for mode in ('in-process', 'model server'):
+      result = measure(mode, num_workers, payloads, args)
+      print(
+        f'{mode:<14}{num_workers:>8}{result["req/s"]:>8.2f}{result["p50 ms"]:>10.1f}'
+        f'{result["worker rss MB"]:>15.1f}{result["total rss MB"]:>14.1f}{result["total pss MB"]:>14.1f}'
+      )
+
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,14 @@
 pkill gunicorn
-./venv/bin/gunicorn -w=2 --bind=localhost:5000 --daemon --error-logfile=error.log server:app
+pkill -f server.ModelServer
+rm -f data/model-server.sock
+# the metrics of the previous workers
+rm -rf data/metrics
+# a new secret for the model server and the workers to authenticate each other with
+export BUGSPLAINER_MODEL_SERVER_AUTHKEY=$(./venv/bin/python -c 'import secrets; print(secrets.token_hex(32))')
+# the models are loaded once by the model server and shared by all the gunicorn workers
+nohup ./venv/bin/python -m server.ModelServer data/model-server.sock >> model-server.log 2>&1 &
+while [ ! -S data/model-server.sock ]; do sleep 1; done
+BUGSPLAINER_MODEL_SERVER=data/model-server.sock BUGSPLAINER_EXPLANATION_CACHE_PATH=data/explanations.sqlite3 BUGSPLAINER_METRICS_DIR=data/metrics ./venv/bin/gunicorn -w=4 --threads=8 --bind=localhost:5000 --daemon --error-logfile=error.log server:app
 
 sudo apt install nginx -y
 yarn build
@@ -0,0 +1,115 @@
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import NamedTuple, List, Dict
+
+from .Bugsplainer import Bugsplainer, Explanation, DecodingProfile, DECODING_PROFILES, DEFAULT_PROFILE
+
+
+class _PendingRequest(NamedTuple):
+  sbt: str
+  num_explanations: int
+  profile: DecodingProfile
+  future: Future
+
+
+_STOP = object()
+
+
+class BatchScheduler:
+  """
+  Queues SBTs submitted from concurrent requests and explains them with a single
+  batched `generate` call. A batch is flushed as soon as it holds `max_batch_size`
+  inputs, or `max_wait_ms` milliseconds after its first input arrived. Inputs of
+  different decoding profiles in a batch are generated separately.
+  """
+
+  def __init__(self, bugsplainer: Bugsplainer, *, max_batch_size=8, max_wait_ms=10):
+    assert max_batch_size > 0, max_batch_size
+    self.bugsplainer = bugsplainer
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+    self._queue = queue.Queue()
+    self._closed = False
+    self._lock = threading.Lock()
+    self._worker = threading.Thread(target=self._run, name='BatchScheduler', daemon=True)
+    self._worker.start()
+
+  def explain(
+      self, sbt: str, num_explanations=10, profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+  ) -> Explanation:
+    return self.submit(sbt, num_explanations, profile).result()
+
+  def submit(
+      self, sbt: str, num_explanations=10, profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+  ) -> 'Future[Explanation]':
+    # validate here, so that a bad request cannot fail the rest of its batch
+    if not 0 < num_explanations <= profile.max_explanations:
+      raise ValueError(
+        f'num_explanations must be between 1 and {profile.max_explanations}, got {num_explanations}'
+      )
+
+    future = Future()
+    with self._lock:
+      if self._closed:
+        raise RuntimeError('BatchScheduler is closed')
+      self._queue.put(_PendingRequest(sbt, num_explanations, profile, future))
+    return future
+
+  def qsize(self) -> int:
+    return self._queue.qsize()
+
+  def close(self):
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      self._queue.put(_STOP)
+    self._worker.join()
+
+  def _run(self):
+    while True:
+      pending = self._queue.get()
+      if pending is _STOP:
+        return
+
+      batch = [pending]
+      deadline = monotonic() + self.max_wait_ms / 1000
+      stop = False
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - monotonic()
+        if timeout <= 0:
+          break
+        try:
+          pending = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if pending is _STOP:
+          stop = True
+          break
+        batch.append(pending)
+
+      self._flush(batch)
+      if stop:
+        return
+
+  def _flush(self, batch: List[_PendingRequest]):
+    batches_of_profile: Dict[DecodingProfile, List[_PendingRequest]] = {}
+    for pending in batch:
+      batches_of_profile.setdefault(pending.profile, []).append(pending)
+
+    for profile, profile_batch in batches_of_profile.items():
+      try:
+        explanations = self.bugsplainer.explain_batch(
+          [pending.sbt for pending in profile_batch],
+          [pending.num_explanations for pending in profile_batch],
+          profile=profile,
+        )
+      except Exception as e:
+        for pending in profile_batch:
+          pending.future.set_exception(e)
+        continue
+
+      for pending, explanation in zip(profile_batch, explanations):
+        pending.future.set_result(explanation)
@@ -1,11 +1,121 @@
-from typing import NamedTuple, List
+import ast
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple, List, Optional, Sequence, Callable, Tuple, Dict, TYPE_CHECKING
 
-from torch import cuda
-from torch import device, tensor, long
-from torch.nn import functional as F
-from transformers import T5Config, RobertaTokenizer, T5ForConditionalGeneration
+# torch and transformers take seconds to import, so they are imported when a
+# model is first loaded, rather than when the server starts
+if TYPE_CHECKING:
+  from torch import Tensor
+  from transformers import RobertaTokenizer
 
-assert cuda.is_available(), 'CUDA is not available'
+  from .InferenceBackend import InferenceBackend
+  from .StructureSuperimposer import StructureSuperImposer
+
+from .Metrics import STAGE_SECONDS, INPUT_TOKENS, BEAM_COUNT, BATCH_SIZE
+
+NUM_BEAMS = 10
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer() -> 'RobertaTokenizer':
+  from transformers import RobertaTokenizer
+
+  # every model is fine-tuned from CodeT5, so they all share its tokenizer
+  return RobertaTokenizer.from_pretrained('Salesforce/codet5-base')
+
+
+def count_sbt_tokens(sbt: str) -> int:
+  """Tokens of an SBT, or of a piece of it, without the prefix and the special tokens."""
+  return len(get_tokenizer().tokenize(sbt))
+
+
+def get_sbt_token_budget(max_length: int, prefix: str) -> int:
+  """Tokens left for the SBT in a model input of `max_length` tokens."""
+  # the prefix, and the <s> and </s> tokens
+  return max_length - count_sbt_tokens(prefix) - 2
+
+
+def to_sbt(structure_superimposer: 'StructureSuperImposer', max_tokens: Optional[int] = None) -> str:
+  """
+  The SBT of the source of `structure_superimposer`. With `max_tokens`, it is shrunk
+  to fit rather than cut off by the tokenizer, which would leave brackets unclosed.
+  """
+  return structure_superimposer.to_bracketed_notation(
+    source_only=True, max_tokens=max_tokens, count_tokens=count_sbt_tokens,
+  )
+
+
+def encode_sources(
+    tokenizer: 'RobertaTokenizer',
+    source_strs: List[str],
+    *,
+    max_length: int,
+    padding_buckets: Optional[Sequence[int]] = None,
+    device=None,
+):
+  """
+  Tokenize `source_strs` into a single tensor padded to the longest input
+  instead of `max_length`. With `padding_buckets`, the length is rounded up to
+  the smallest bucket that fits, so that only a few tensor shapes are used.
+  The pad positions are masked out, so explanations are the same as if every
+  input were padded to `max_length`.
+  """
+  from torch import tensor, long
+
+  source_ids = [
+    tokenizer.encode(source_str, max_length=max_length, truncation=True)
+    for source_str in source_strs
+  ]
+  length = max(len(ids) for ids in source_ids)
+  if padding_buckets:
+    length = min(
+      (bucket for bucket in padding_buckets if length <= bucket <= max_length),
+      default=max_length,
+    )
+  source_ids = [
+    ids + [tokenizer.pad_token_id] * (length - len(ids))
+    for ids in source_ids
+  ]
+  return tensor(source_ids, dtype=long, device=device)
+
+
+class EncoderCache:
+  """
+  LRU cache of the encoder hidden states of recent inputs, keyed by their token ids
+  without padding, so that decoding them again, e.g. for a different number of
+  explanations or another decoding profile, skips the encoder.
+  """
+
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self._entries: 'OrderedDict[Tuple[int, ...], Tensor]' = OrderedDict()
+    self._counters = {'hits': 0, 'misses': 0}
+    self._lock = threading.Lock()
+
+  def get(self, key: Tuple[int, ...]) -> Optional['Tensor']:
+    with self._lock:
+      hidden_states = self._entries.get(key)
+      if hidden_states is not None:
+        self._entries.move_to_end(key)
+      self._counters['hits' if hidden_states is not None else 'misses'] += 1
+      return hidden_states
+
+  def set(self, key: Tuple[int, ...], hidden_states: 'Tensor'):
+    with self._lock:
+      self._entries[key] = hidden_states
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {**self._counters, 'size': len(self._entries)}
 
 
 class Explanation(NamedTuple):
@@ -13,18 +123,86 @@ class Explanation(NamedTuple):
   scores: List[int]
 
 
+class DecodingProfile(NamedTuple):
+  """Parameters of `generate` that trade the quality of explanations for speed."""
+  num_beams: int
+  # maximum number of tokens of an explanation; `None` keeps the default of the model
+  max_length: Optional[int] = None
+  no_repeat_ngram_size: int = 0
+  # sample the explanations with nucleus sampling rather than searching beams
+  do_sample: bool = False
+  top_p: float = 1.
+
+  @property
+  def max_explanations(self) -> int:
+    # beam search returns at most one explanation per beam
+    return NUM_BEAMS if self.do_sample else self.num_beams
+
+  def generation_params(self) -> Dict:
+    """The parameters that differ from the defaults, to identify the profile in cache keys."""
+    return {
+      field: value for field, value in self._asdict().items()
+      if field not in DecodingProfile._field_defaults or value != DecodingProfile._field_defaults[field]
+    }
+
+
+DECODING_PROFILES: Dict[str, DecodingProfile] = {
+  'fast': DecodingProfile(num_beams=2, max_length=32),
+  'balanced': DecodingProfile(num_beams=5, max_length=64, no_repeat_ngram_size=3),
+  'quality': DecodingProfile(num_beams=NUM_BEAMS),
+  'sampled': DecodingProfile(num_beams=1, max_length=64, do_sample=True, top_p=.9),
+}
+DEFAULT_PROFILE = 'quality'
+
+
+class _StepCallback:
+  """
+  A stopping criterion of `generate` that never stops the generation, only reports
+  the running beams after every step. `generate` only calls its stopping criteria,
+  so it does not subclass `StoppingCriteria`, which would import transformers.
+  """
+
+  def __init__(self, callback: Callable):
+    self.callback = callback
+
+  def __call__(self, input_ids, scores, **kwargs) -> bool:
+    self.callback(input_ids)
+    return False
+
+
 class Bugsplainer:
-  def __init__(self, *, max_length: int, config_path: str, model_path: str):
+  def __init__(
+      self, *, max_length: int, config_path: str, model_path: str,
+      padding_buckets: Optional[Sequence[int]] = None,
+      prefix='finetune sbt-random: ',
+      backend: Optional['InferenceBackend'] = None,
+      encoder_cache_size=32,
+      name='',
+  ):
+    from transformers import T5Config, T5ForConditionalGeneration
+
+    from .InferenceBackend import InferenceBackend
+
+    # labels the metrics of the model
+    self.name = name
     self.max_length = max_length
-    self.device = device('cuda')
+    self.prefix = prefix
+    self.padding_buckets = padding_buckets
+    self.backend = backend or InferenceBackend()
+    self.device = self.backend.device
     config = T5Config.from_pretrained(config_path)
-    self.tokenizer = RobertaTokenizer.from_pretrained('Salesforce/codet5-base')
-    self.model: T5ForConditionalGeneration = T5ForConditionalGeneration.from_pretrained(model_path, config=config)
-    self.model.to(self.device)
-    self.model.eval()
+    self.tokenizer = get_tokenizer()
+    if self.backend.config.int8:
+      from .Quantization import load_quantized
+
+      self.model = load_quantized(model_path, config)
+    else:
+      self.model: T5ForConditionalGeneration = T5ForConditionalGeneration.from_pretrained(model_path, config=config)
+    self.backend.prepare(self.model)
+    self.encoder_cache = EncoderCache(encoder_cache_size)
 
   @staticmethod
-  def make_sbt_from_diff(code: str, diff: str):
+  def make_sbt_from_diff(code: str, diff: str, max_tokens: Optional[int] = None):
     if len(diff.split()) > 100:
       raise Exception('You are using base version of Bugsplainer which under-performs '
                       'when the diff contains more than 100 whitespace-tokens. '
@@ -32,37 +210,172 @@ class Bugsplainer:
     from .StructureSuperimposer import StructureSuperImposer
 
     structure_superimposer = StructureSuperImposer.from_diff(code, diff)
-    return structure_superimposer.to_bracketed_notation(source_only=True)
+    return to_sbt(structure_superimposer, max_tokens)
 
   @staticmethod
-  def make_sbt_from_span(code: str, start: int, end: int):
+  def make_sbts_from_diff_hunks(code: str, diff: str, max_tokens: Optional[int] = None) -> List[str]:
+    """One SBT per hunk of the diff, to explain diffs of any size hunk by hunk."""
+    from .StructureSuperimposer import StructureSuperImposer
+
+    return [
+      to_sbt(structure_superimposer, max_tokens)
+      for structure_superimposer in StructureSuperImposer.from_diff_hunks(code, diff)
+    ]
+
+  @staticmethod
+  def make_sbt_from_span(code: str, start: int, end: int, max_tokens: Optional[int] = None):
     from .StructureSuperimposer import StructureSuperImposer
 
     structure_superimposer = StructureSuperImposer.from_source_code(code, start, end)
-    return structure_superimposer.to_bracketed_notation(source_only=True)
-
-  def explain(self, sbt: str, num_explanations=10):
-    source_str = f"finetune sbt-random: {sbt}"
-    source_ids = self.tokenizer.encode(source_str, max_length=self.max_length, padding='max_length', truncation=True)
-    source_tensor = tensor([source_ids], dtype=long, device=self.device)
-    source_mask = source_tensor.ne(self.tokenizer.pad_token_id)
-
-    outputs = self.model.generate(
-      inputs=source_tensor,
-      attention_mask=source_mask,
-      early_stopping=True,
-      num_beams=10,
-      num_return_sequences=num_explanations,
-      output_scores=True,
-      return_dict_in_generate=True,
-    )
+    return to_sbt(structure_superimposer, max_tokens)
 
-    explanations = [
-      self.tokenizer.decode(seq, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-      for seq in outputs.sequences
-    ]
+  @staticmethod
+  def make_sbt_from_tree_span(tree: ast.Module, start: int, end: int, max_tokens: Optional[int] = None) -> str:
+    from .StructureSuperimposer import StructureSuperImposer
+
+    [structure_superimposer] = StructureSuperImposer.from_tree_spans(tree, [(start, end)])
+    return to_sbt(structure_superimposer, max_tokens)
+
+  def count_tokens(self, sbt: str) -> int:
+    return len(self.tokenizer.encode(f"{self.prefix}{sbt}", max_length=self.max_length, truncation=True))
 
-    return Explanation(
-      explanations,
-      F.softmax(outputs.sequences_scores, dim=0).tolist(),
+  def explain(self, sbt: str, num_explanations=10, profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE]):
+    return self.explain_batch([sbt], [num_explanations], profile=profile)[0]
+
+  def explain_batch(
+      self, sbts: List[str], num_explanations: List[int],
+      on_step: Optional[Callable[[List[List[str]]], None]] = None,
+      profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+  ) -> List[Explanation]:
+    """
+    Explain several SBTs with a single call to `generate`. Each input may ask
+    for a different number of explanations; the batch is generated with the
+    largest one, and every input receives the top `num_explanations[i]` beams.
+    If given, `on_step` is called after every decoding step with the running
+    top `num_explanations[i]` hypotheses of every input. `profile` sets the decoding
+    parameters; sampled explanations are ranked by their mean log-probability.
+    """
+    from torch.nn import functional as F
+    from transformers import StoppingCriteriaList
+    from transformers.modeling_outputs import BaseModelOutput
+
+    assert len(sbts) == len(num_explanations), (len(sbts), len(num_explanations))
+    with STAGE_SECONDS.time(model=self.name, stage='tokenize'):
+      source_tensor = encode_sources(
+        self.tokenizer,
+        [f"{self.prefix}{sbt}" for sbt in sbts],
+        max_length=self.max_length,
+        padding_buckets=self.padding_buckets,
+        device=self.device,
+      )
+      source_mask = source_tensor.ne(self.tokenizer.pad_token_id)
+
+    BATCH_SIZE.observe(len(sbts), model=self.name)
+    for num_tokens in source_mask.sum(dim=1).tolist():
+      INPUT_TOKENS.observe(num_tokens, model=self.name)
+      BEAM_COUNT.observe(profile.num_beams, model=self.name)
+
+    num_return_sequences = max(num_explanations)
+    # beam search runs `num_beams` hypotheses of every input, sampling `num_return_sequences`
+    num_hypotheses = max(profile.num_beams, num_return_sequences)
+    stopping_criteria = StoppingCriteriaList()
+    if on_step is not None:
+      def report_hypotheses(input_ids):
+        # the hypotheses of every input are contiguous, during beam search best first
+        on_step([
+          self.tokenizer.batch_decode(
+            input_ids[i * num_hypotheses: i * num_hypotheses + num_explanation],
+            skip_special_tokens=True, clean_up_tokenization_spaces=True,
+          )
+          for i, num_explanation in enumerate(num_explanations)
+        ])
+
+      stopping_criteria.append(_StepCallback(report_hypotheses))
+
+    with STAGE_SECONDS.time(model=self.name, stage='generate'), self.backend.inference_context():
+      # `generate` expands the encoder outputs for the beams in place, so always pass new ones
+      encoder_outputs = BaseModelOutput(last_hidden_state=self.encode(source_tensor, source_mask))
+      outputs = self.model.generate(
+        inputs=source_tensor,
+        attention_mask=source_mask,
+        encoder_outputs=encoder_outputs,
+        early_stopping=True,
+        num_return_sequences=num_return_sequences,
+        output_scores=True,
+        return_dict_in_generate=True,
+        stopping_criteria=stopping_criteria,
+        **profile._asdict(),
+      )
+      sequences_scores = outputs.sequences_scores if profile.num_beams > 1 else self._score_sequences(outputs)
+
+    explanations = []
+    with STAGE_SECONDS.time(model=self.name, stage='decode'):
+      for i, num_explanation in enumerate(num_explanations):
+        # `generate` returns the sequences of every input contiguously, beams best first
+        offset = i * num_return_sequences
+        sequences = outputs.sequences[offset: offset + num_return_sequences]
+        scores = sequences_scores[offset: offset + num_return_sequences]
+        if profile.num_beams == 1:
+          order = scores.argsort(descending=True)
+          sequences, scores = sequences[order], scores[order]
+        sequences, scores = sequences[:num_explanation], scores[:num_explanation]
+        explanations.append(Explanation(
+          [
+            self.tokenizer.decode(seq, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for seq in sequences
+          ],
+          F.softmax(scores.float(), dim=0).tolist(),
+        ))
+
+    return explanations
+
+  def encode(self, source_tensor: 'Tensor', source_mask: 'Tensor') -> 'Tensor':
+    """
+    The encoder hidden states of a padded batch of inputs. Only the inputs that
+    are not in `encoder_cache` are encoded, in a single batch.
+    """
+    from torch import tensor, long
+
+    encoder = self.model.get_encoder()
+    if not self.encoder_cache.max_size:
+      return encoder(input_ids=source_tensor, attention_mask=source_mask).last_hidden_state
+
+    lengths = source_mask.sum(dim=1).tolist()
+    keys = [tuple(ids[:length].tolist()) for ids, length in zip(source_tensor, lengths)]
+    hidden_states = [self.encoder_cache.get(key) for key in keys]
+    missing = [i for i, states in enumerate(hidden_states) if states is None]
+    if missing:
+      index = tensor(missing, dtype=long, device=source_tensor.device)
+      encoded = encoder(input_ids=source_tensor[index], attention_mask=source_mask[index]).last_hidden_state
+      if len(missing) == len(keys):
+        for i, states in enumerate(encoded):
+          # clone, so that the cache does not keep the whole batch alive
+          self.encoder_cache.set(keys[i], states[:lengths[i]].clone())
+        return encoded
+
+      for i, states in zip(missing, encoded):
+        hidden_states[i] = states[:lengths[i]].clone()
+        self.encoder_cache.set(keys[i], hidden_states[i])
+
+    # the pad positions are masked out, so they can be left zero
+    batch_hidden_states = hidden_states[0].new_zeros(
+      (len(keys), source_tensor.shape[1], hidden_states[0].shape[-1]),
     )
+    for i, states in enumerate(hidden_states):
+      batch_hidden_states[i, :lengths[i]] = states
+    return batch_hidden_states
+
+  def _score_sequences(self, outputs) -> 'Tensor':
+    """
+    `generate` scores beams only. Score sampled sequences alike, by the mean
+    log-probability of their tokens, excluding the padding after they end.
+    """
+    from torch import stack
+
+    # the first token of every sequence is the decoder start token, which is not scored
+    tokens = outputs.sequences[:, 1:]
+    log_probs = stack(outputs.scores, dim=1).float().log_softmax(dim=-1)
+    token_log_probs = log_probs.gather(-1, tokens.unsqueeze(-1)).squeeze(-1)
+    mask = tokens.ne(self.tokenizer.pad_token_id)
+    token_log_probs = token_log_probs.masked_fill(~mask, 0.)
+    return token_log_probs.sum(dim=-1) / mask.sum(dim=-1).clamp(min=1)
@@ -0,0 +1,125 @@
+import ast
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Hashable
+
+from .Bugsplainer import Explanation
+from .StructureSuperimposer import StructureSuperImposer
+
+# explanations kept per document, for its most recently explained spans
+MAX_EXPLAINED_PER_DOCUMENT = 32
+_explained_lock = threading.Lock()
+
+
+def apply_edits(source: str, edits: List[Dict]) -> str:
+  """
+  Apply the edits ({offset, length, text}) one after another. Each edit replaces
+  `length` characters from `offset` of the source as left by the previous edits.
+  """
+  for edit in edits:
+    if not isinstance(edit, dict) or not isinstance(edit.get('text'), str):
+      raise ValueError('An edit must be {offset, length, text}')
+    offset = edit.get('offset')
+    length = edit.get('length', 0)
+    if not isinstance(offset, int) or not isinstance(length, int) \
+        or offset < 0 or length < 0 or offset + length > len(source):
+      raise ValueError(f'Edit of {length} characters at {offset} is outside of the source')
+    source = source[:offset] + edit['text'] + source[offset + length:]
+
+  return source
+
+
+def _hash_of(model_input: str) -> str:
+  return hashlib.sha256(model_input.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+@dataclass
+class Document:
+  """
+  A version of a source being edited. Edits make a new `Document`, so a request
+  always reads the source and the tree of the same version.
+  """
+  source: str
+  version: int = 0
+  # explanation by (model, start, end, num_explanations), with the hash of the model input it explains.
+  # It is shared by all the versions of a document.
+  explained: 'OrderedDict[Hashable, Tuple[str, Explanation]]' = field(default_factory=OrderedDict)
+  _tree: Optional[ast.Module] = field(default=None, repr=False)
+
+  def tree(self) -> ast.Module:
+    """The tree of the source, parsed on first use."""
+    if self._tree is None:
+      self._tree = StructureSuperImposer.parse_ast_with_async_await_check(self.source)
+    return self._tree
+
+  def get_explanation(self, key: Hashable, model_input: str) -> Optional[Explanation]:
+    """The explanation of `key`, if it was made for the same model input."""
+    with _explained_lock:
+      entry = self.explained.get(key)
+    if entry is None or entry[0] != _hash_of(model_input):
+      return None
+    return entry[1]
+
+  def set_explanation(self, key: Hashable, model_input: str, explanation: Explanation):
+    input_hash = _hash_of(model_input)
+    with _explained_lock:
+      self.explained[key] = input_hash, explanation
+      self.explained.move_to_end(key)
+      while len(self.explained) > MAX_EXPLAINED_PER_DOCUMENT:
+        self.explained.popitem(last=False)
+
+
+class DocumentStore:
+  """
+  The latest version of the documents being edited, by their ids. When full,
+  the least recently used documents are dropped. Documents are kept by each
+  server process, so clients must send the whole source again when a document
+  is unknown to the process serving them.
+  """
+
+  def __init__(self, *, max_size: int):
+    self.max_size = max_size
+    self._documents: 'OrderedDict[str, Document]' = OrderedDict()
+    self._lock = threading.Lock()
+
+  def open(self, document_id: str, source: str) -> Document:
+    with self._lock:
+      previous = self._documents.get(document_id)
+      document = Document(source)
+      if previous is not None:
+        document.version = previous.version + 1
+        document.explained = previous.explained
+      self._put(document_id, document)
+      return document
+
+  def edit(self, document_id: str, edits: List[Dict], version: Optional[int] = None) -> Optional[Document]:
+    """
+    Apply the edits to the latest version of the document. Returns `None` if the
+    document is unknown, or if `version` is given and is not the latest version.
+    """
+    with self._lock:
+      previous = self._documents.get(document_id)
+      if previous is None or (version is not None and version != previous.version):
+        return None
+      if not edits:
+        self._documents.move_to_end(document_id)
+        return previous
+
+      source = apply_edits(previous.source, edits)
+      document = Document(source, previous.version + 1, previous.explained)
+      if source == previous.source:
+        # the edits cancel out, keep the parsed tree
+        document._tree = previous._tree
+      self._put(document_id, document)
+      return document
+
+  def __len__(self):
+    return len(self._documents)
+
+  def _put(self, document_id: str, document: Document):
+    self._documents[document_id] = document
+    self._documents.move_to_end(document_id)
+    while len(self._documents) > self.max_size:
+      self._documents.popitem(last=False)
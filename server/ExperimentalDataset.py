@@ -0,0 +1,223 @@
+"""
+The experimental test set can be read from its CSV file, or from a memory-mapped
+file that keeps each file content once. To convert the CSV, run
+
+  python -m server.ExperimentalDataset data/test-sbt-random-finetune.csv data/test-sbt-random-finetune.bspx
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, NamedTuple
+
+MAPPED_EXTENSION = '.bspx'
+# a mapped file starts with the magic bytes and the offset of its metadata,
+# followed by the UTF-8 encoded file contents and the JSON encoded metadata
+_MAGIC = b'BSPXDS01'
+_HEADER = struct.Struct('<8sQ')
+
+
+@dataclass
+class ExperimentalFile:
+  content: str
+  start: List[int]
+  end: List[int]
+  commit_message: List[str]
+
+
+class ExperimentalDataset:
+  """
+  The experimental test set, read once on first use and indexed by file.
+  It is read again whenever the CSV file is modified.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._mtime: Optional[float] = None
+    self._files: Dict[Tuple[str, str], ExperimentalFile] = {}
+    self._filenames: List[str] = []
+    self._lock = threading.Lock()
+
+  def filenames(self) -> List[str]:
+    self._ensure_loaded()
+    return self._filenames
+
+  def get(self, filename: str) -> Optional[ExperimentalFile]:
+    self._ensure_loaded()
+    return self._files.get(self._key_of(filename))
+
+  @staticmethod
+  def _key_of(filename: str) -> Tuple[str, str]:
+    filename_parts = filename.split('/')
+    repo = '.'.join(filename_parts[:2])
+    path = '/'.join(filename_parts[2:])
+    return repo, path
+
+  def _ensure_loaded(self):
+    mtime = os.stat(self.path).st_mtime
+    if mtime == self._mtime:
+      return
+
+    with self._lock:
+      if mtime != self._mtime:
+        self._load()
+        self._mtime = mtime
+
+  def _load(self):
+    # pandas is slow to import, so it is imported when the dataset is first read
+    import pandas as pd
+
+    df: pd.DataFrame = pd.read_csv(
+      self.path, usecols=['repo', 'path', 'commit_message', 'content', 'start', 'end'],
+    )
+
+    # many rows are spans of the same file, so keep a single copy of each content
+    contents: Dict[str, str] = {}
+    rows_of_file: Dict[Tuple[str, str], List[int]] = {}
+    for i, key in enumerate(zip(df['repo'].tolist(), df['path'].tolist())):
+      rows_of_file.setdefault(key, []).append(i)
+
+    content_column = df['content'].tolist()
+    start_column = df['start'].tolist()
+    end_column = df['end'].tolist()
+    commit_message_column = df['commit_message'].tolist()
+    files = {}
+    for key, rows in rows_of_file.items():
+      content = content_column[rows[0]]
+      files[key] = ExperimentalFile(
+        content=contents.setdefault(content, content),
+        start=[start_column[i] for i in rows],
+        end=[end_column[i] for i in rows],
+        commit_message=[commit_message_column[i] for i in rows],
+      )
+
+    filenames: pd.Series = df['repo'].str.replace('.', '/', regex=False) + '/' + df['path']
+    filenames = filenames[filenames.str.len() < 50]
+
+    self._files = files
+    self._filenames = filenames[-100:].sort_values().tolist()
+
+
+class _MappedFile(NamedTuple):
+  content_offset: int
+  content_length: int
+  start: List[int]
+  end: List[int]
+  commit_message: List[str]
+
+
+class MappedExperimentalDataset(ExperimentalDataset):
+  """
+  The experimental test set in a file written by `convert_csv`. Only the spans
+  are read into memory; file contents are sliced from the memory-mapped file.
+  """
+
+  def __init__(self, path: str):
+    super().__init__(path)
+    self._mmap: Optional[mmap.mmap] = None
+
+  def get(self, filename: str) -> Optional[ExperimentalFile]:
+    self._ensure_loaded()
+    # the map of a previous version of the file is closed once a new one is loaded
+    with self._lock:
+      mapped_file: Optional[_MappedFile] = self._files.get(self._key_of(filename))
+      if mapped_file is None:
+        return None
+      content_end = mapped_file.content_offset + mapped_file.content_length
+      content = self._mmap[mapped_file.content_offset: content_end]
+
+    return ExperimentalFile(
+      content=content.decode('utf-8'),
+      start=mapped_file.start,
+      end=mapped_file.end,
+      commit_message=mapped_file.commit_message,
+    )
+
+  def _load(self):
+    with open(self.path, 'rb') as file:
+      mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, metadata_offset = _HEADER.unpack_from(mapped)
+    assert magic == _MAGIC, f'{self.path} is not an experimental dataset file'
+    metadata = json.loads(mapped[metadata_offset:].decode('utf-8'))
+
+    self._files = {
+      tuple(key.split('\t', 1)): _MappedFile(*mapped_file)
+      for key, mapped_file in metadata['files'].items()
+    }
+    self._filenames = metadata['filenames']
+    if self._mmap is not None:
+      self._mmap.close()
+    self._mmap = mapped
+
+
+def open_experimental_dataset(path: str) -> ExperimentalDataset:
+  if path.endswith(MAPPED_EXTENSION):
+    return MappedExperimentalDataset(path)
+  return ExperimentalDataset(path)
+
+
+def convert_csv(csv_path: str, output_path: str, chunksize=1000):
+  """
+  Write the CSV test set as a `MappedExperimentalDataset` file, reading it in chunks.
+  The file is written next to `output_path` and moved into place once complete, so
+  that a server reading `output_path` never maps a partly written file.
+  """
+  temp_path = f'{output_path}.{os.getpid()}.tmp'
+  try:
+    _write_mapped(csv_path, temp_path, chunksize)
+    os.replace(temp_path, output_path)
+  except BaseException:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    raise
+
+
+def _write_mapped(csv_path: str, output_path: str, chunksize: int):
+  import pandas as pd
+
+  content_offsets: Dict[bytes, Tuple[int, int]] = {}
+  files: Dict[str, list] = {}
+  filenames = deque(maxlen=100)
+
+  with open(output_path, 'wb') as output:
+    output.write(_HEADER.pack(_MAGIC, 0))
+    for df in pd.read_csv(
+        csv_path, usecols=['repo', 'path', 'commit_message', 'content', 'start', 'end'], chunksize=chunksize,
+    ):
+      for row in df.itertuples(index=False):
+        key = f'{row.repo}\t{row.path}'
+        if key not in files:
+          content = row.content.encode('utf-8')
+          content_hash = hashlib.sha1(content).digest()
+          if content_hash not in content_offsets:
+            content_offsets[content_hash] = (output.tell(), len(content))
+            output.write(content)
+          files[key] = [*content_offsets[content_hash], [], [], []]
+
+        files[key][2].append(int(row.start))
+        files[key][3].append(int(row.end))
+        files[key][4].append(row.commit_message)
+
+        filename = row.repo.replace('.', '/') + '/' + row.path
+        if len(filename) < 50:
+          filenames.append(filename)
+
+    metadata_offset = output.tell()
+    output.write(json.dumps({'files': files, 'filenames': sorted(filenames)}).encode('utf-8'))
+    output.seek(0)
+    output.write(_HEADER.pack(_MAGIC, metadata_offset))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert the experimental test set into a memory-mappable file')
+  parser.add_argument('csv_path')
+  parser.add_argument('output_path')
+  args = parser.parse_args()
+
+  convert_csv(args.csv_path, args.output_path)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from time import time
+from typing import Optional, Dict
+
+from .Bugsplainer import Explanation
+
+
+def make_cache_key(model: str, sbt: str, num_explanations: int, **generation_params) -> str:
+  key = json.dumps(
+    [model, sbt.strip(), num_explanations, generation_params], sort_keys=True,
+  )
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ExplanationCache(ABC):
+  """
+  Size-bounded cache of explanations, keyed by `make_cache_key`. When full, the
+  least recently used entries are evicted. Entries older than `ttl` seconds expire.
+  """
+
+  def __init__(self, *, max_size: int, ttl: float):
+    self.max_size = max_size
+    self.ttl = ttl
+
+  def get(self, key: str) -> Optional[Explanation]:
+    explanation = self._get(key)
+    self._count('hits' if explanation is not None else 'misses')
+    return explanation
+
+  @abstractmethod
+  def set(self, key: str, explanation: Explanation):
+    ...
+
+  @abstractmethod
+  def stats(self) -> Dict[str, int]:
+    ...
+
+  @abstractmethod
+  def _get(self, key: str) -> Optional[Explanation]:
+    ...
+
+  @abstractmethod
+  def _count(self, counter: str):
+    ...
+
+
+class InMemoryExplanationCache(ExplanationCache):
+  def __init__(self, *, max_size: int, ttl: float):
+    super().__init__(max_size=max_size, ttl=ttl)
+    self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+    self._counters = {'hits': 0, 'misses': 0}
+    self._lock = threading.Lock()
+
+  def _get(self, key: str) -> Optional[Explanation]:
+    with self._lock:
+      if key not in self._entries:
+        return None
+      created, explanation = self._entries[key]
+      if created + self.ttl < time():
+        del self._entries[key]
+        return None
+      self._entries.move_to_end(key)
+      return explanation
+
+  def set(self, key: str, explanation: Explanation):
+    with self._lock:
+      self._entries[key] = (time(), explanation)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def _count(self, counter: str):
+    with self._lock:
+      self._counters[counter] += 1
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {**self._counters, 'size': len(self._entries)}
+
+
+class SqliteExplanationCache(ExplanationCache):
+  """Cache in an SQLite file, shared by every process that opens the same file."""
+
+  def __init__(self, path: str, *, max_size: int, ttl: float):
+    super().__init__(max_size=max_size, ttl=ttl)
+    self.path = path
+    self._local = threading.local()
+    with self._connect() as connection:
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS explanations '
+        '(key TEXT PRIMARY KEY, explanation TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)'
+      )
+      connection.execute('CREATE INDEX IF NOT EXISTS explanations_accessed ON explanations (accessed)')
+      connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+      connection.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+
+  def _connect(self) -> sqlite3.Connection:
+    # sqlite connections can not be shared across threads
+    if not hasattr(self._local, 'connection'):
+      self._local.connection = sqlite3.connect(self.path, timeout=10)
+      self._local.connection.execute('PRAGMA journal_mode=WAL')
+    return self._local.connection
+
+  def _get(self, key: str) -> Optional[Explanation]:
+    now = time()
+    with self._connect() as connection:
+      row = connection.execute(
+        'SELECT explanation FROM explanations WHERE key = ? AND created >= ?', (key, now - self.ttl),
+      ).fetchone()
+      if row is None:
+        return None
+      connection.execute('UPDATE explanations SET accessed = ? WHERE key = ?', (now, key))
+    return Explanation(*json.loads(row[0]))
+
+  def set(self, key: str, explanation: Explanation):
+    now = time()
+    with self._connect() as connection:
+      connection.execute(
+        'INSERT OR REPLACE INTO explanations VALUES (?, ?, ?, ?)',
+        (key, json.dumps(explanation), now, now),
+      )
+      connection.execute('DELETE FROM explanations WHERE created < ?', (now - self.ttl,))
+      connection.execute(
+        'DELETE FROM explanations WHERE key IN '
+        '(SELECT key FROM explanations ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+        (self.max_size,),
+      )
+
+  def _count(self, counter: str):
+    with self._connect() as connection:
+      connection.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (counter,))
+
+  def stats(self) -> Dict[str, int]:
+    connection = self._connect()
+    stats = dict(connection.execute('SELECT name, value FROM counters').fetchall())
+    stats['size'] = connection.execute('SELECT COUNT(*) FROM explanations').fetchone()[0]
+    return stats
@@ -0,0 +1,70 @@
+import contextlib
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+
+@dataclass
+class BackendConfig:
+  # 'auto' picks CUDA when it is available, and CPU otherwise
+  device: str = 'auto'
+  # thread counts of the CPU path. They are shared by the whole process,
+  # so the first CPU model that is loaded decides them.
+  num_threads: Optional[int] = None
+  num_interop_threads: Optional[int] = None
+  # run the CPU path under bfloat16 autocast
+  bf16: bool = False
+  # quantize the linear layers to int8. Only supported on CPU.
+  int8: bool = False
+
+
+class InferenceBackend:
+  """Puts a model on the device of a `BackendConfig` and runs inference on it."""
+
+  _cpu_threads_configured = False
+
+  def __init__(self, config: Optional[BackendConfig] = None):
+    self.config = config or BackendConfig()
+    self.device = self.select_device(
+      'cpu' if self.config.int8 and self.config.device == 'auto' else self.config.device,
+    )
+    assert not self.config.int8 or self.device.type == 'cpu', 'int8 models can only run on CPU'
+    if self.device.type == 'cpu':
+      self._configure_cpu_threads()
+
+  @staticmethod
+  def select_device(name: str) -> torch.device:
+    if name == 'auto':
+      return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    _device = torch.device(name)
+    if _device.type == 'cuda':
+      assert torch.cuda.is_available(), 'CUDA is not available'
+    return _device
+
+  def _configure_cpu_threads(self):
+    if InferenceBackend._cpu_threads_configured:
+      return
+    InferenceBackend._cpu_threads_configured = True
+
+    num_threads = self.config.num_threads or os.cpu_count()
+    torch.set_num_threads(num_threads)
+    try:
+      # only allowed before the first inter-op parallel work of the process
+      torch.set_num_interop_threads(self.config.num_interop_threads or max(1, num_threads // 2))
+    except RuntimeError:
+      pass
+
+  def prepare(self, model: torch.nn.Module) -> torch.nn.Module:
+    model.to(self.device)
+    model.eval()
+    return model
+
+  def inference_context(self):
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if self.device.type == 'cpu' and self.config.bf16:
+      stack.enter_context(torch.autocast('cpu', dtype=torch.bfloat16))
+    return stack
@@ -0,0 +1,214 @@
+import json
+import os
+import queue
+import re
+import threading
+import uuid
+from time import time, sleep
+from typing import Callable, Dict, List, Optional, Tuple, Iterator, Union
+
+from .Bugsplainer import Explanation, DECODING_PROFILES, DEFAULT_PROFILE
+from .SbtPool import make_error_record
+
+JOB_DONE_STATUSES = ('done', 'failed')
+# seconds between two sweeps of the expired jobs
+SWEEP_INTERVAL = 60
+
+
+class JobQueue:
+  """
+  Explains many spans in the background. Identical items of a job are explained
+  once, and the items of each model are explained in batches of `batch_size`.
+  `make_model_inputs` makes the model inputs of all the items of a job at once,
+  returning the error record of the items that have none.
+
+  The status and results of every job are written to `job_dir`, so that any
+  server process can report them, not only the one running the job. They are
+  deleted `ttl` seconds after the job is done.
+  """
+
+  def __init__(
+      self,
+      job_dir: str,
+      *,
+      make_model_inputs: Callable[[List[Dict]], List[Union[str, Dict]]],
+      explain_batch: Callable[[str, List[str], List[int]], List[Explanation]],
+      num_workers=1,
+      batch_size=32,
+      ttl: float = 24 * 60 * 60,
+      max_explanations=DECODING_PROFILES[DEFAULT_PROFILE].max_explanations,
+  ):
+    self.job_dir = job_dir
+    self.make_model_inputs = make_model_inputs
+    self.explain_batch = explain_batch
+    self.batch_size = batch_size
+    self.ttl = ttl
+    self.max_explanations = max_explanations
+    self._queue = queue.Queue()
+    for i in range(num_workers):
+      threading.Thread(target=self._run, name=f'JobQueue-{i}', daemon=True).start()
+
+  def submit(self, items: List[Dict]) -> str:
+    job_id = uuid.uuid4().hex
+    # on the first job rather than when the server is imported
+    os.makedirs(self.job_dir, exist_ok=True)
+    open(self._results_path(job_id), 'w').close()
+    self._write_status(job_id, {
+      'id': job_id,
+      'status': 'queued',
+      'num_items': len(items),
+      'num_done': 0,
+      'created': time(),
+      'completed': None,
+    })
+    self._queue.put((job_id, items))
+    return job_id
+
+  def qsize(self) -> int:
+    return self._queue.qsize()
+
+  def status(self, job_id: str) -> Optional[Dict]:
+    # job ids come from URLs, so never let them point outside `job_dir`
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+      return None
+    try:
+      with open(self._status_path(job_id)) as status_file:
+        return json.load(status_file)
+    except FileNotFoundError:
+      return None
+
+  def results(self, job_id: str, poll_interval=0.2) -> Iterator[str]:
+    """
+    Yield the JSON lines of the results as they are written, until the job is done.
+    `job_id` must be of an existing job.
+    """
+    with open(self._results_path(job_id)) as results_file:
+      while True:
+        position = results_file.tell()
+        line = results_file.readline()
+        if line.endswith('\n'):
+          yield line
+          continue
+
+        # the line is still being written, read it again later
+        results_file.seek(position)
+        if self.status(job_id)['status'] in JOB_DONE_STATUSES:
+          rest = results_file.read()
+          if rest:
+            yield rest
+          return
+        sleep(poll_interval)
+
+  def _run(self):
+    swept = 0.
+    while True:
+      if time() - swept >= SWEEP_INTERVAL:
+        self._sweep()
+        swept = time()
+      try:
+        job_id, items = self._queue.get(timeout=SWEEP_INTERVAL)
+      except queue.Empty:
+        continue
+      status = self.status(job_id)
+      self._write_status(job_id, {**status, 'status': 'running'})
+      try:
+        with open(self._results_path(job_id), 'a') as results_file:
+          self._run_job(job_id, items, results_file)
+        self._write_status(job_id, {**self.status(job_id), 'status': 'done', 'completed': time()})
+      except Exception as e:
+        self._write_status(job_id, {
+          **self.status(job_id), 'status': 'failed', 'completed': time(), 'error': repr(e),
+        })
+
+  def _run_job(self, job_id: str, items: List[Dict], results_file):
+    num_done = 0
+
+    def write_result(index: int, result: Dict):
+      nonlocal num_done
+      results_file.write(json.dumps({'index': index, **result}) + '\n')
+      num_done += 1
+
+    # indices of the items of each distinct (model, model input, num_explanations)
+    indices: Dict[Tuple[str, str, int], List[int]] = {}
+    for i, (item, model_input) in enumerate(zip(items, self.make_model_inputs(items))):
+      if isinstance(model_input, dict):
+        write_result(i, {'error': model_input})
+        continue
+      num_explanations = item.get('num_explanations') or 3
+      # a batch is generated with its largest num_explanations, so one bad item would fail the whole batch
+      if type(num_explanations) is not int or not 0 < num_explanations <= self.max_explanations:
+        write_result(i, {'error': make_error_record(ValueError(
+          f'num_explanations must be between 1 and {self.max_explanations}, got {num_explanations!r}'
+        ))})
+        continue
+      key = item['model'], model_input, num_explanations
+      indices.setdefault(key, []).append(i)
+
+    results_file.flush()
+    self._write_status(job_id, {**self.status(job_id), 'num_done': num_done})
+
+    keys_of_model: Dict[str, List[Tuple[str, str, int]]] = {}
+    for key in indices:
+      keys_of_model.setdefault(key[0], []).append(key)
+
+    for model, keys in keys_of_model.items():
+      for batch_start in range(0, len(keys), self.batch_size):
+        batch = keys[batch_start: batch_start + self.batch_size]
+        try:
+          explanations = self.explain_batch(
+            model, [key[1] for key in batch], [key[2] for key in batch],
+          )
+          results = [
+            {
+              'model': model,
+              'explanations': [
+                {'explanation': explanation, 'score': score}
+                for explanation, score in zip(*_explanation)
+              ],
+            }
+            for _explanation in explanations
+          ]
+        except Exception as e:
+          results = [{'error': make_error_record(e)}] * len(batch)
+
+        for key, result in zip(batch, results):
+          for i in indices[key]:
+            write_result(i, result)
+        results_file.flush()
+        self._write_status(job_id, {**self.status(job_id), 'num_done': num_done})
+
+  def _sweep(self):
+    """Delete the status and results of the jobs that were done more than `ttl` seconds ago."""
+    expired = time() - self.ttl
+    try:
+      filenames = os.listdir(self.job_dir)
+    except FileNotFoundError:
+      # no job was submitted yet
+      return
+    for filename in filenames:
+      job_id, extension = os.path.splitext(filename)
+      if extension != '.json':
+        continue
+      status = self.status(job_id)
+      if status is None or status['status'] not in JOB_DONE_STATUSES or status['completed'] > expired:
+        continue
+      # the status first, so that the job is not found without its results
+      for path in (self._status_path(job_id), self._results_path(job_id)):
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          # swept by another server process
+          pass
+
+  def _write_status(self, job_id: str, status: Dict):
+    # write and rename, so that the status is never read half-written
+    temp_path = self._status_path(job_id) + '.tmp'
+    with open(temp_path, 'w') as status_file:
+      json.dump(status, status_file)
+    os.replace(temp_path, self._status_path(job_id))
+
+  def _status_path(self, job_id: str) -> str:
+    return os.path.join(self.job_dir, f'{job_id}.json')
+
+  def _results_path(self, job_id: str) -> str:
+    return os.path.join(self.job_dir, f'{job_id}.jsonl')
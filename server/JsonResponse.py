@@ -0,0 +1,44 @@
+"""
+JSON responses that are serialized once, with the `id`, `created` and `completed`
+of the request merged into the payload before encoding, rather than parsed back
+out of every response body. Encoded with orjson when it is installed, and with
+the JSON encoder of Flask otherwise.
+"""
+from time import time
+
+from flask import current_app, json, request, has_request_context, Response
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+def _default(o):
+  # what orjson cannot encode natively, e.g. dates, as Flask would
+  return json.JSONEncoder().default(o)
+
+
+def dumps(data) -> bytes:
+  if orjson is not None:
+    return orjson.dumps(data, default=_default)
+  return json.dumps(data).encode('utf-8')
+
+
+def jsonify(*args, **kwargs) -> Response:
+  """Like `flask.jsonify`. Objects are sent with the id and timestamps of the current request, unless they have their own."""
+  if args and kwargs:
+    raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+  data = args[0] if len(args) == 1 else args or kwargs
+
+  # set by `set_req_ids`, unless the request failed before it
+  if isinstance(data, dict) and has_request_context() and 'id' in request.environ:
+    data = {
+      'id': str(request.environ['id']),
+      'created': request.environ['created'],
+      'completed': time(),
+      # e.g. the id and times of a job are not overridden by those of the request
+      **data,
+    }
+
+  return current_app.response_class(dumps(data), mimetype='application/json')
@@ -0,0 +1,228 @@
+"""
+Histograms of the latency of every stage of explaining, rendered in the Prometheus
+text exposition format by `/metrics`.
+"""
+import math
+import os
+import pickle
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter, sleep, time, time_ns
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[str, ...]
+
+
+class HistogramSnapshot(NamedTuple):
+  documentation: str
+  label_names: Tuple[str, ...]
+  buckets: Tuple[float, ...]
+  # non-cumulative count of every bucket and of +Inf, sum, and count, by label values
+  samples: Dict[Labels, Tuple[List[int], float, int]]
+
+
+class Gauge(NamedTuple):
+  name: str
+  documentation: str
+  label_names: Tuple[str, ...]
+  values: Dict[Labels, float]
+
+
+class Histogram:
+  def __init__(self, name: str, documentation: str, label_names: Sequence[str], buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.documentation = documentation
+    self.label_names = tuple(label_names)
+    self.buckets = tuple(sorted(buckets))
+    self._samples: Dict[Labels, Tuple[List[int], float, int]] = {}
+    self._lock = threading.Lock()
+
+  def observe(self, value: float, **labels):
+    key = tuple(str(labels[name]) for name in self.label_names)
+    # the first bucket whose upper bound is at least the value, or +Inf
+    bucket = bisect_left(self.buckets, value)
+    with self._lock:
+      counts, total, count = self._samples.get(key) or ([0] * (len(self.buckets) + 1), 0., 0)
+      counts[bucket] += 1
+      self._samples[key] = counts, total + value, count + 1
+
+  @contextmanager
+  def time(self, **labels):
+    started = perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(perf_counter() - started, **labels)
+
+  def snapshot(self) -> HistogramSnapshot:
+    with self._lock:
+      samples = {key: (list(counts), total, count) for key, (counts, total, count) in self._samples.items()}
+    return HistogramSnapshot(self.documentation, self.label_names, self.buckets, samples)
+
+
+class Metrics:
+  """The histograms of a process. Snapshots of several processes can be rendered together."""
+
+  def __init__(self):
+    self._histograms: Dict[str, Histogram] = {}
+
+  def histogram(self, name: str, documentation: str, label_names: Sequence[str], buckets=DEFAULT_BUCKETS):
+    assert name not in self._histograms, name
+    self._histograms[name] = Histogram(name, documentation, label_names, buckets)
+    return self._histograms[name]
+
+  def snapshot(self) -> Dict[str, HistogramSnapshot]:
+    return {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+
+
+class SharedMetrics:
+  """
+  The metrics of every process that shares `directory`, e.g. the gunicorn workers.
+  Each process writes the snapshot of its histograms and the values of its own gauges
+  to a file of its own every `interval` seconds, and reads the files of all of them
+  when it serves `/metrics`. The histograms of exited processes are kept, as their
+  counts only ever increase, but their gauges are not.
+  """
+
+  def __init__(
+      self, directory: str, metrics: 'Metrics', *,
+      gauges: Callable[[], List[Gauge]] = lambda: [], interval: float = 5.,
+  ):
+    self.directory = directory
+    self.metrics = metrics
+    self.gauges = gauges
+    self.interval = interval
+    self._pid: Optional[int] = None
+    self._path: Optional[str] = None
+    self._lock = threading.Lock()
+
+  def start(self):
+    """Start writing the metrics of this process, unless it already does. Call it in every forked process."""
+    if self._pid == os.getpid():
+      return
+    with self._lock:
+      if self._pid != os.getpid():
+        # threads are not forked, so the process starts its own, with a file of its own
+        os.makedirs(self.directory, exist_ok=True)
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, f'{self._pid}-{time_ns()}.pickle')
+        threading.Thread(target=self._write_periodically, daemon=True).start()
+
+  def write(self):
+    temp_path = f'{self._path}.tmp'
+    with open(temp_path, 'wb') as file:
+      pickle.dump((self.metrics.snapshot(), self.gauges()), file)
+    # so that readers never see a partly written file
+    os.replace(temp_path, self._path)
+
+  def read(self) -> Tuple[List[Dict[str, HistogramSnapshot]], List[Gauge]]:
+    """The snapshots of all the processes, and their gauges summed by name and labels."""
+    self.start()
+    self.write()
+
+    snapshots = []
+    gauges: Dict[str, Gauge] = {}
+    for filename in os.listdir(self.directory):
+      path = os.path.join(self.directory, filename)
+      if not filename.endswith('.pickle'):
+        continue
+      try:
+        modified = os.stat(path).st_mtime
+        with open(path, 'rb') as file:
+          snapshot, process_gauges = pickle.load(file)
+      except (OSError, EOFError, pickle.UnpicklingError):
+        continue
+      snapshots.append(snapshot)
+
+      # the process has exited if it has not written its file for a while
+      if time() - modified > 2 * self.interval:
+        continue
+      for gauge in process_gauges:
+        if gauge.name not in gauges:
+          gauges[gauge.name] = Gauge(gauge.name, gauge.documentation, gauge.label_names, {})
+        values = gauges[gauge.name].values
+        for key, value in gauge.values.items():
+          values[key] = values.get(key, 0) + value
+    return snapshots, list(gauges.values())
+
+  def _write_periodically(self):
+    while True:
+      try:
+        self.write()
+      except OSError:
+        # e.g. the directory was removed, and may be created again
+        pass
+      sleep(self.interval)
+
+
+def render(snapshots: List[Dict[str, HistogramSnapshot]], gauges: List[Gauge] = ()) -> str:
+  """The histograms of all the snapshots, summed by name and labels, and the gauges."""
+  merged: Dict[str, HistogramSnapshot] = {}
+  for snapshot in snapshots:
+    for name, histogram in snapshot.items():
+      if name not in merged:
+        merged[name] = HistogramSnapshot(histogram.documentation, histogram.label_names, histogram.buckets, {})
+      samples = merged[name].samples
+      for key, (counts, total, count) in histogram.samples.items():
+        if key in samples:
+          merged_counts, merged_total, merged_count = samples[key]
+          counts = [a + b for a, b in zip(merged_counts, counts)]
+          total, count = merged_total + total, merged_count + count
+        samples[key] = counts, total, count
+
+  lines = []
+  for name, histogram in merged.items():
+    lines.append(f'# HELP {name} {histogram.documentation}')
+    lines.append(f'# TYPE {name} histogram')
+    for key, (counts, total, count) in sorted(histogram.samples.items()):
+      labels = list(zip(histogram.label_names, key))
+      cumulative = 0
+      for upper_bound, bucket_count in zip([*histogram.buckets, math.inf], counts):
+        cumulative += bucket_count
+        le = '+Inf' if upper_bound == math.inf else repr(float(upper_bound))
+        lines.append(f'{name}_bucket{_format_labels([*labels, ("le", le)])} {cumulative}')
+      lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+      lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+  for gauge in gauges:
+    lines.append(f'# HELP {gauge.name} {gauge.documentation}')
+    lines.append(f'# TYPE {gauge.name} gauge')
+    for key, value in sorted(gauge.values.items()):
+      lines.append(f'{gauge.name}{_format_labels(list(zip(gauge.label_names, key)))} {value}')
+
+  return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+  if not labels:
+    return ''
+  escaped = (
+    (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    for name, value in labels
+  )
+  return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+metrics = Metrics()
+REQUEST_SECONDS = metrics.histogram(
+  'bugsplainer_request_seconds', 'Latency of HTTP requests, until the first byte of streamed ones',
+  ('endpoint', 'status'),
+)
+STAGE_SECONDS = metrics.histogram(
+  'bugsplainer_stage_seconds',
+  'Time spent in each stage of explaining: parse, sbt, tokenize, generate and decode',
+  ('model', 'stage'),
+)
+INPUT_TOKENS = metrics.histogram(
+  'bugsplainer_input_tokens', 'Number of tokens of each model input', ('model',),
+  buckets=(16, 32, 64, 128, 256, 384, 512),
+)
+BEAM_COUNT = metrics.histogram(
+  'bugsplainer_beams', 'Number of beams each input is generated with', ('model',), buckets=(1, 2, 5, 10),
+)
+BATCH_SIZE = metrics.histogram(
+  'bugsplainer_batch_size', 'Number of inputs of each generate call', ('model',), buckets=(1, 2, 4, 8, 16, 32),
+)
@@ -0,0 +1,204 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .BatchScheduler import BatchScheduler
+from .Bugsplainer import Bugsplainer
+
+
+def get_model_size(bugsplainer: Bugsplainer) -> int:
+  """Bytes taken by the parameters and buffers of the model."""
+  model = bugsplainer.model
+  return sum(
+    tensor.numel() * tensor.element_size()
+    for tensor in [*model.parameters(), *model.buffers()]
+  )
+
+
+class ModelRegistry:
+  """
+  Loads every model once, on its first use, and keeps it in memory.
+  When `memory_budget` (in bytes) is set and loading a model would exceed it,
+  the least recently used models are unloaded before it is loaded. The size of a
+  model is estimated by its `size_estimators` until it has been loaded once.
+  Unloaded models are reloaded on their next use.
+  The load state of every model is reported by `load_states`.
+
+  A model is loaded outside the lock of the registry, so that the models that are
+  already loaded are served meanwhile. Concurrent first uses of a model wait for
+  the same load. A model that is `use`d directly, rather than through its
+  scheduler, is not unloaded until it is no longer used.
+  """
+
+  def __init__(
+      self,
+      loaders: Dict[str, Callable[[], Bugsplainer]],
+      *,
+      memory_budget: Optional[int] = None,
+      size_estimators: Optional[Dict[str, Callable[[], int]]] = None,
+      max_batch_size=8,
+      max_wait_ms=10,
+  ):
+    self.loaders = loaders
+    self.memory_budget = memory_budget
+    self.size_estimators = size_estimators or {}
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+    self._schedulers: 'OrderedDict[str, BatchScheduler]' = OrderedDict()
+    self._sizes: Dict[str, int] = {}
+    # sizes of the models that have been loaded before, to make room for them when they are reloaded
+    self._measured_sizes: Dict[str, int] = {}
+    # the memory set aside for every model being loaded, and the errors of the models that failed to load
+    self._loading: Dict[str, int] = {}
+    self._errors: Dict[str, str] = {}
+    # the number of callers that `use` every model
+    self._users: Dict[str, int] = {}
+    self._lock = threading.Lock()
+    # notified when a model is no longer used, and so can be unloaded
+    self._released = threading.Condition(self._lock)
+    self._load_locks = {name: threading.Lock() for name in loaders}
+
+  def __contains__(self, name: str):
+    return name in self.loaders
+
+  def is_loaded(self, name: str) -> bool:
+    return name in self._schedulers
+
+  def load_states(self) -> Dict[str, str]:
+    """'loaded', 'loading', 'failed' or 'unloaded' by model name. Never waits for a model to load."""
+    states = {}
+    for name in self.loaders:
+      if name in self._schedulers:
+        states[name] = 'loaded'
+      elif name in self._loading:
+        states[name] = 'loading'
+      elif name in self._errors:
+        states[name] = 'failed'
+      else:
+        states[name] = 'unloaded'
+    return states
+
+  def memory_usage(self) -> int:
+    return sum(self._sizes.values())
+
+  def stats(self) -> Dict[str, Dict[str, int]]:
+    """The memory and the number of queued inputs of every loaded model. Never waits for a model to load."""
+    schedulers, sizes = self._schedulers.copy(), self._sizes.copy()
+    return {
+      name: {'memory_bytes': sizes.get(name, 0), 'queue_depth': scheduler.qsize()}
+      for name, scheduler in schedulers.items()
+    }
+
+  def get(self, name: str) -> BatchScheduler:
+    if name not in self.loaders:
+      raise KeyError(name)
+
+    scheduler = self._get_loaded(name)
+    if scheduler is not None:
+      return scheduler
+
+    with self._load_locks[name]:
+      # loaded by another thread while this one waited
+      scheduler = self._get_loaded(name)
+      if scheduler is not None:
+        return scheduler
+
+      estimated_size = self._measured_sizes.get(name)
+      if estimated_size is None:
+        estimator = self.size_estimators.get(name)
+        estimated_size = estimator() if estimator else 0
+      with self._lock:
+        # make room before loading, so that memory never holds the budget and the new model
+        unloaded = self._make_room(estimated_size)
+        self._loading[name] = estimated_size
+      self._close(unloaded)
+
+      try:
+        bugsplainer = self.loaders[name]()
+      except Exception as e:
+        with self._lock:
+          self._errors[name] = repr(e)
+          del self._loading[name]
+        raise
+
+      size = get_model_size(bugsplainer)
+      scheduler = BatchScheduler(bugsplainer, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms)
+      with self._lock:
+        del self._loading[name]
+        self._errors.pop(name, None)
+        self._measured_sizes[name] = size
+        # in case the model is larger than estimated
+        unloaded = self._make_room(size)
+        self._schedulers[name] = scheduler
+        self._sizes[name] = size
+      self._close(unloaded)
+      return scheduler
+
+  @contextmanager
+  def use(self, name: str) -> Iterator[Bugsplainer]:
+    """
+    The model itself, for callers that explain with it rather than with its scheduler,
+    e.g. to stream hypotheses or to generate batches larger than those of the scheduler.
+    """
+    while True:
+      scheduler = self.get(name)
+      with self._lock:
+        # unless it was unloaded in the meantime
+        if self._schedulers.get(name) is scheduler:
+          self._users[name] = self._users.get(name, 0) + 1
+          break
+    try:
+      yield scheduler.bugsplainer
+    finally:
+      with self._lock:
+        self._users[name] -= 1
+        self._released.notify_all()
+
+  def unload(self, name: str):
+    with self._lock:
+      while self._users.get(name):
+        self._released.wait()
+      unloaded = [self._pop(name)] if name in self._schedulers else []
+    self._close(unloaded)
+
+  def _get_loaded(self, name: str) -> Optional[BatchScheduler]:
+    with self._lock:
+      scheduler = self._schedulers.get(name)
+      if scheduler is not None:
+        self._schedulers.move_to_end(name)
+      return scheduler
+
+  def _make_room(self, size: int) -> List[BatchScheduler]:
+    """
+    Unload the least recently used models until `size` more bytes fit. Models in use
+    are only unloaded once they are no longer used, so that they are never in memory
+    twice when they are reloaded meanwhile. Must hold the lock.
+    """
+    unloaded = []
+    if self.memory_budget is None:
+      return unloaded
+    # along with the memory set aside for the other models being loaded
+    while self.memory_usage() + size + sum(self._loading.values()) > self.memory_budget:
+      unused = [name for name in self._schedulers if not self._users.get(name)]
+      if unused:
+        unloaded.append(self._pop(unused[0]))
+      elif self._schedulers:
+        self._released.wait()
+      else:
+        break
+    return unloaded
+
+  def _pop(self, name: str) -> BatchScheduler:
+    del self._sizes[name]
+    return self._schedulers.pop(name)
+
+  @staticmethod
+  def _close(schedulers: List[BatchScheduler]):
+    for scheduler in schedulers:
+      # requests that are already queued are still explained before it stops
+      scheduler.close()
+      if scheduler.bugsplainer.device.type == 'cuda':
+        import torch
+
+        torch.cuda.empty_cache()
@@ -0,0 +1,195 @@
+"""
+Serves the models of a `ModelRegistry` to the HTTP workers over a local socket,
+so that the models are loaded once however many workers there are. Start it with
+
+  python -m server.ModelServer data/model-server.sock
+
+and the workers with `BUGSPLAINER_MODEL_SERVER=data/model-server.sock`. Explanations
+requested by all the workers are batched together by the `BatchScheduler` of each model.
+"""
+import argparse
+import os
+import threading
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, Connection
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .Bugsplainer import Explanation, DecodingProfile, DECODING_PROFILES, DEFAULT_PROFILE
+from .Metrics import metrics, HistogramSnapshot
+from .ModelRegistry import ModelRegistry
+
+
+def get_authkey() -> bytes:
+  """The secret that the model server and its workers authenticate each other with."""
+  # anyone who can connect to the socket with the key can unpickle objects in the other process
+  authkey = os.environ.get('BUGSPLAINER_MODEL_SERVER_AUTHKEY')
+  if not authkey:
+    raise RuntimeError('Set BUGSPLAINER_MODEL_SERVER_AUTHKEY to the same secret for the model server and its workers')
+  return authkey.encode('utf-8')
+
+
+class ModelServer:
+  """
+  Answers the calls of `RemoteModelRegistry`s, one thread per connection. A call is
+  a tuple of the method name and its arguments. It is answered with ('result', value)
+  or ('error', exception), preceded by ('step', hypotheses) messages when streaming.
+  """
+
+  def __init__(self, model_registry: ModelRegistry, address: str, authkey: Optional[bytes] = None):
+    self.model_registry = model_registry
+    self.address = address
+    self.authkey = authkey or get_authkey()
+
+  def serve_forever(self):
+    if os.path.exists(self.address):
+      # left over by a previous run
+      os.remove(self.address)
+    with Listener(self.address, family='AF_UNIX', authkey=self.authkey) as listener:
+      while True:
+        try:
+          connection = listener.accept()
+        except (OSError, EOFError, AuthenticationError):
+          # e.g. a client with a wrong authkey
+          continue
+        threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+  def _serve(self, connection: Connection):
+    with connection:
+      while True:
+        try:
+          method, args = connection.recv()
+        except (EOFError, OSError):
+          return
+        try:
+          result = getattr(self, f'_call_{method}')(connection, *args)
+        except Exception as e:
+          self._send_error(connection, e)
+        else:
+          connection.send(('result', result))
+
+  @staticmethod
+  def _send_error(connection: Connection, error: Exception):
+    try:
+      connection.send(('error', error))
+    except Exception:
+      # the error cannot be pickled, which happens before anything is sent
+      connection.send(('error', RuntimeError(repr(error))))
+
+  def _call_explain(self, connection, model: str, sbt: str, num_explanations: int, profile: DecodingProfile):
+    return self.model_registry.get(model).explain(sbt, num_explanations, profile)
+
+  def _call_explain_batch(
+      self, connection, model: str, sbts: List[str], num_explanations: List[int],
+      profile: DecodingProfile, stream: bool,
+  ):
+    on_step = None
+    if stream:
+      def on_step(hypotheses):
+        connection.send(('step', hypotheses))
+
+    with self.model_registry.use(model) as bugsplainer:
+      return bugsplainer.explain_batch(sbts, num_explanations, on_step=on_step, profile=profile)
+
+  def _call_load_states(self, connection):
+    return self.model_registry.load_states()
+
+  def _call_stats(self, connection):
+    return self.model_registry.stats()
+
+  def _call_metrics(self, connection):
+    return metrics.snapshot()
+
+
+class RemoteModelRegistry:
+  """
+  Stands in for a `ModelRegistry` in the HTTP workers, forwarding the calls to a
+  `ModelServer`. Each thread keeps its own connection.
+  """
+
+  def __init__(self, address: str, authkey: Optional[bytes] = None):
+    self.address = address
+    self.authkey = authkey or get_authkey()
+    self._local = threading.local()
+
+  def get(self, name: str) -> '_RemoteScheduler':
+    return _RemoteScheduler(self, name)
+
+  @contextmanager
+  def use(self, name: str) -> Iterator['_RemoteBugsplainer']:
+    # the model server keeps the model loaded while it explains with it
+    yield _RemoteBugsplainer(self, name)
+
+  def load_states(self) -> Dict[str, str]:
+    return self.call('load_states')
+
+  def stats(self) -> Dict[str, Dict[str, int]]:
+    return self.call('stats')
+
+  def metrics_snapshot(self) -> Dict[str, HistogramSnapshot]:
+    """The metrics of the model server process, such as the generation time of its models."""
+    return self.call('metrics')
+
+  def call(self, method: str, *args, on_step: Optional[Callable] = None):
+    connection: Optional[Connection] = getattr(self._local, 'connection', None)
+    if connection is None or connection.closed:
+      connection = self._local.connection = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+    try:
+      connection.send((method, args))
+      while True:
+        kind, value = connection.recv()
+        if kind != 'step':
+          break
+        on_step(value)
+    except BaseException:
+      # e.g. the model server restarted, or the call was left midway; connect again on the next call
+      connection.close()
+      raise
+
+    if kind == 'error':
+      raise value
+    return value
+
+
+class _RemoteScheduler:
+  """The part of `BatchScheduler` that the server uses, for a model of a `ModelServer`."""
+
+  def __init__(self, registry: RemoteModelRegistry, model: str):
+    self.registry = registry
+    self.model = model
+
+  def explain(
+      self, sbt: str, num_explanations=10, profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+  ) -> Explanation:
+    return self.registry.call('explain', self.model, sbt, num_explanations, profile)
+
+
+class _RemoteBugsplainer:
+  """The part of `Bugsplainer` that the server uses, for a model of a `ModelServer`."""
+
+  def __init__(self, registry: RemoteModelRegistry, model: str):
+    self.registry = registry
+    self.model = model
+
+  def explain_batch(
+      self, sbts: List[str], num_explanations: List[int],
+      on_step: Optional[Callable[[List[List[str]]], None]] = None,
+      profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+  ) -> List[Explanation]:
+    return self.registry.call(
+      'explain_batch', self.model, sbts, num_explanations, profile, on_step is not None, on_step=on_step,
+    )
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Serve the models to the HTTP workers over a Unix socket')
+  parser.add_argument('address', help='path of the Unix socket')
+  args = parser.parse_args()
+  # before loading the models, which takes a while
+  authkey = get_authkey()
+
+  # loads the models, unless `BUGSPLAINER_MODEL_SERVER` is set, which would make the server its own client
+  from . import model_registry
+
+  assert isinstance(model_registry, ModelRegistry), 'unset BUGSPLAINER_MODEL_SERVER to run the model server'
+  ModelServer(model_registry, args.address, authkey).serve_forever()
@@ -0,0 +1,56 @@
+"""
+Dynamic int8 quantization of the linear layers of T5 models, for CPU inference.
+
+Quantizing a model on every startup is slow, so the quantized weights can be saved
+next to the original checkpoint once:
+
+  python -m server.Quantization server/models/config_220m.json \\
+    server/models/268.finetune-sbt-random-512-64-16-220m/output/checkpoint-best-bleu
+"""
+import argparse
+import os
+
+import torch
+from transformers import T5Config, T5ForConditionalGeneration
+
+QUANTIZED_CHECKPOINT = 'pytorch_model.int8.bin'
+
+
+def quantize(model: T5ForConditionalGeneration) -> T5ForConditionalGeneration:
+  return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(model_path: str, config: T5Config) -> str:
+  model = T5ForConditionalGeneration.from_pretrained(model_path, config=config)
+  model.eval()
+  checkpoint_path = os.path.join(model_path, QUANTIZED_CHECKPOINT)
+  torch.save(quantize(model).state_dict(), checkpoint_path)
+  return checkpoint_path
+
+
+def load_quantized(model_path: str, config: T5Config) -> T5ForConditionalGeneration:
+  """
+  Load the quantized checkpoint saved by `save_quantized`, if any.
+  Otherwise, quantize the original checkpoint.
+  """
+  checkpoint_path = os.path.join(model_path, QUANTIZED_CHECKPOINT)
+  if not os.path.exists(checkpoint_path):
+    model = T5ForConditionalGeneration.from_pretrained(model_path, config=config)
+    model.eval()
+    return quantize(model)
+
+  # build the quantized modules first, so that the packed int8 weights fit in
+  model = quantize(T5ForConditionalGeneration(config))
+  model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+  return model
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Save dynamically int8-quantized T5 checkpoints')
+  parser.add_argument('config_path')
+  parser.add_argument('model_paths', nargs='+')
+  args = parser.parse_args()
+
+  _config = T5Config.from_pretrained(args.config_path)
+  for _model_path in args.model_paths:
+    print('saved', save_quantized(_model_path, _config))
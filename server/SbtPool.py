@@ -0,0 +1,130 @@
+"""
+Builds the SBTs of many spans in a pool of processes. Building an SBT is
+pure Python and holds the GIL, so bulk jobs would otherwise keep a single core busy
+while the model waits for its inputs.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from time import sleep
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+from . import StructureSuperimposer as structure_superimposer_module
+from .Bugsplainer import to_sbt
+from .StructureSuperimposer import StructureSuperImposer
+
+# the SBT of an input, or the error record of why it has none
+SbtResult = Union[str, Dict]
+
+T = TypeVar('T')
+
+
+def make_error_record(error: Exception) -> Dict:
+  """What went wrong with an input, as reported in the results of a job."""
+  if isinstance(error, SyntaxError):
+    return {
+      'type': SyntaxError.__name__,
+      'line': error.lineno,
+      'col': error.offset,
+      'text': error.text,
+    }
+  return {'type': type(error).__name__, 'message': repr(error)}
+
+
+class SbtPool:
+  """
+  Builds SBTs in `num_processes` processes, or in the calling thread if it is 1.
+  The inputs are grouped by file, so that each file is parsed once, and only the
+  SBT strings and error records are sent back, in the order of the inputs.
+
+  The processes are forked by `start`, which must be called before the calling
+  process starts any thread, as a forked process only has a copy of the thread that
+  forked it and any lock held by another thread stays locked in it. Until then, or
+  once a process dies, SBTs are built in the calling thread.
+  """
+
+  def __init__(self, num_processes: int):
+    self.num_processes = num_processes
+    self._executor: Optional[ProcessPoolExecutor] = None
+    self._lock = threading.Lock()
+
+  def make_sbts_from_spans(
+      self, spans: List[Tuple[str, int, int]], max_tokens: Optional[int] = None,
+  ) -> List[SbtResult]:
+    """The SBT of each (code, start, end) span, in at most `max_tokens` tokens if set."""
+    return self._map_grouped(_make_sbts_of_file, [(code, (start, end)) for code, start, end in spans], max_tokens)
+
+  def start(self):
+    """Fork the processes, unless there is to be only one."""
+    with self._lock:
+      if self.num_processes <= 1 or self._executor is not None:
+        return
+      # forked rather than spawned or started by a fork server, which would import the whole
+      # server again in every process
+      self._executor = ProcessPoolExecutor(
+        self.num_processes, mp_context=multiprocessing.get_context('fork'), initializer=_init_process,
+      )
+      # a task for each process, so that all of them are forked now, whether the executor
+      # starts its processes together or as tasks come
+      list(self._executor.map(sleep, [.01] * self.num_processes))
+
+  def close(self):
+    with self._lock:
+      if self._executor is not None:
+        self._executor.shutdown()
+        self._executor = None
+
+  def _map_grouped(
+      self, make_sbts: Callable[[str, List[T], Optional[int]], List[SbtResult]], inputs: List[Tuple[str, T]],
+      max_tokens: Optional[int],
+  ) -> List[SbtResult]:
+    make_sbts = partial(make_sbts, max_tokens=max_tokens)
+    # indices of the inputs of each file, in order of first appearance
+    indices_of_file: Dict[str, List[int]] = {}
+    for i, (file, _) in enumerate(inputs):
+      indices_of_file.setdefault(file, []).append(i)
+    files = list(indices_of_file)
+    args_of_files = [[inputs[i][1] for i in indices_of_file[file]] for file in files]
+
+    executor = self._executor
+    if executor is None or len(files) <= 1:
+      sbts_of_files = map(make_sbts, files, args_of_files)
+    else:
+      # a few tasks per process, so that they stay busy without sending each file on its own
+      chunk_size = max(1, len(files) // (self.num_processes * 4))
+      try:
+        sbts_of_files = list(executor.map(make_sbts, files, args_of_files, chunksize=chunk_size))
+      except BrokenProcessPool:
+        # e.g. a process was killed. New ones would be forked while other threads run.
+        self.close()
+        sbts_of_files = map(make_sbts, files, args_of_files)
+
+    results: List[Optional[SbtResult]] = [None] * len(inputs)
+    for file, sbts in zip(files, sbts_of_files):
+      for i, sbt in zip(indices_of_file[file], sbts):
+        results[i] = sbt
+    return results
+
+
+def _init_process():
+  # the cache of the forked process may have been locked by another thread at the time of the fork
+  structure_superimposer_module._parsed_tree_cache = structure_superimposer_module._ParsedTreeCache()
+
+
+def _make_sbts_of_file(code: str, spans: List[Tuple[int, int]], max_tokens: Optional[int]) -> List[SbtResult]:
+  try:
+    tree = StructureSuperImposer.parse_ast_with_async_await_check(code)
+  except SyntaxError as e:
+    return [make_error_record(e)] * len(spans)
+
+  sbts = []
+  for start, end in spans:
+    try:
+      [structure_superimposer] = StructureSuperImposer.from_tree_spans(tree, [(start, end)])
+      sbts.append(to_sbt(structure_superimposer, max_tokens))
+    except Exception as e:
+      sbts.append(make_error_record(e))
+  return sbts
+
@@ -1,8 +1,14 @@
 import ast
+import copy
+import hashlib
 import os
 import re
 import sys
-from typing import List, Optional, Union
+import threading
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 from unidiff import PatchSet, PatchedFile, Hunk
 
@@ -21,6 +27,93 @@ def _make_indent(level: int, indent: Optional[int]):
   return '\n' + (' ' * (level * indent))
 
 
+class _SbtType(NamedTuple):
+  fields: Tuple[str, ...]
+  opening_token: str
+  closing_token: str
+  is_dict: bool
+
+
+# `_SbtType` of every AST node type that has been serialized
+_SBT_TYPES: Dict[type, _SbtType] = {}
+
+
+def _make_sbt_type(node_type: type) -> _SbtType:
+  sbt_type = _SbtType(
+    fields=tuple(field for field in node_type._fields if field != 'ctx'),
+    opening_token='(' + node_type.__name__,
+    closing_token=')' + node_type.__name__,
+    is_dict=issubclass(node_type, ast.Dict),
+  )
+  _SBT_TYPES[node_type] = sbt_type
+  return sbt_type
+
+
+class _ParsedTreeCache:
+  """
+  LRU cache of parsed modules, and of the `SyntaxError`s of sources that do not
+  parse, keyed by the hash of the source. The cached trees are shared, so they
+  must never be mutated.
+  """
+
+  def __init__(self):
+    self._entries: 'OrderedDict[Tuple[bytes, str], Union[ast.Module, SyntaxError]]' = OrderedDict()
+    self._lock = threading.Lock()
+
+  def parse(self, source: str, filename: str, max_size: int) -> ast.Module:
+    key = hashlib.sha1(source.encode('utf-8', 'surrogatepass')).digest(), filename
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+
+    if entry is None:
+      try:
+        entry = StructureSuperImposer._parse_ast_with_async_await_check(source, filename)
+      except SyntaxError as e:
+        entry = e.with_traceback(None)
+      with self._lock:
+        self._entries[key] = entry
+        while len(self._entries) > max_size:
+          self._entries.popitem(last=False)
+
+    if isinstance(entry, SyntaxError):
+      # raise a copy, so that the tracebacks of each raise do not pile up on the cached error
+      raise copy.copy(entry)
+    return entry
+
+
+_parsed_tree_cache = _ParsedTreeCache()
+
+
+class _NodeRange:
+  """
+  The pieces of the SBT of a node, from `start` till `end`, and its closest serialized
+  ancestor. The ranges of its descendants follow it, up to `subtree_end`.
+  """
+  __slots__ = 'node', 'depth', 'parent', 'start', 'end', 'subtree_end', 'has_children'
+
+  def __init__(self, node: ast.AST, depth: int, parent: Optional[int], start: int):
+    self.node = node
+    self.depth = depth
+    self.parent = parent
+    self.start = start
+    self.end = start
+    self.subtree_end: Optional[int] = None
+    self.has_children = False
+
+
+class _StatementIndex(NamedTuple):
+  linenos: List[int]
+  end_linenos: List[int]
+
+
+# `_StatementIndex` of the top-level statements of every module that has been queried
+_statement_indexes: 'weakref.WeakKeyDictionary[ast.Module, _StatementIndex]' = weakref.WeakKeyDictionary()
+# whether each AST node type is a unit type, see `StructureSuperImposer._is_unit_type`
+_UNIT_TYPES: Dict[type, bool] = {}
+
+
 # noinspection DuplicatedCode
 class StructureSuperImposer:
   def __init__(
@@ -29,9 +122,20 @@ class StructureSuperImposer:
     self.source_nodes = source_nodes
     self.target_nodes = target_nodes
 
-  def to_bracketed_notation(self, delimiter: Optional[str] = None, indent=0, source_only=False):
+  def to_bracketed_notation(
+      self, delimiter: Optional[str] = None, indent=0, source_only=False,
+      max_tokens: Optional[int] = None, count_tokens: Optional[Callable[[str], int]] = None,
+  ):
+    """
+    With `max_tokens`, the source is shrunk to at most that many tokens as counted by
+    `count_tokens`, see `get_bracketed_notation_within`. Only supported with `source_only`.
+    """
     if bool(delimiter) == bool(source_only):
       assert False, f'Invalid combination delimiter: {delimiter}, source_only: {source_only}'
+    assert max_tokens is None or (source_only and not indent and count_tokens), 'Invalid token budget'
+
+    if max_tokens is not None:
+      return StructureSuperImposer.get_bracketed_notation_within(self.source_nodes, max_tokens, count_tokens)
 
     bracketed_src = StructureSuperImposer.get_bracketed_notation_of(self.source_nodes, indent)
     if source_only:
@@ -62,39 +166,185 @@ class StructureSuperImposer:
   def get_bracketed_notation_of(
       cls, nodes: RecursiveStmts, indent: Optional[int], level=0
   ) -> str:
-    bracketed_notation = ''
-    for node in nodes:
-      if isinstance(node, list):
-        bracketed_notation += cls.get_bracketed_notation_of(
-          node, indent, level=level + 1
-        )
-      elif isinstance(node, ast.AST):
-        _fields = filter(lambda field: field != 'ctx', node._fields)
-        children = [node.__getattribute__(field) for field in _fields]
-        children = list(filter(lambda x: x is not None, children))
-        if isinstance(node, ast.Dict):
-          assert len(children) == 2
-          children = [list(pair) for pair in zip(children[0], children[1])]
-        bracketed_notation += _make_indent(level, indent)
-        bracketed_notation += '('
-        bracketed_notation += type(node).__name__
-        bracketed_notation += cls.get_bracketed_notation_of(
-          children, indent, level=level + 1,
-        )
-        bracketed_notation += ')'
-        bracketed_notation += type(node).__name__
+    return ''.join(cls._serialize(nodes, indent, level))
+
+  @classmethod
+  def get_bracketed_notation_within(
+      cls, nodes: RecursiveStmts, max_tokens: int, count_tokens: Callable[[str], int],
+  ) -> str:
+    """
+    The SBT of `nodes` in at most `max_tokens` tokens, rather than cut off after
+    tokenizing it, which would leave brackets unclosed. Long string literals are
+    elided first, then the deepest subtrees are collapsed into empty nodes, e.g.
+    `(Call)Call`, and last the trailing statements are dropped. Tokens are counted
+    once per distinct piece of the SBT, and summed per subtree.
+    """
+    node_ranges: List[_NodeRange] = []
+    tokens = cls._serialize(nodes, None, node_ranges=node_ranges)
+    sbt = ''.join(tokens)
+    num_tokens = count_tokens(sbt)
+    if num_tokens <= max_tokens:
+      return sbt
+
+    piece_counts: Dict[str, int] = {'': 0}
+
+    def count_piece(piece: str) -> int:
+      piece_count = piece_counts.get(piece)
+      if piece_count is None:
+        piece_count = piece_counts[piece] = count_tokens(piece)
+      return piece_count
+
+    # number of tokens before every piece, to sum the tokens of any subtree
+    offsets = [0]
+    for token in tokens:
+      offsets.append(offsets[-1] + count_piece(token))
+    costs = [offsets[node_range.end] - offsets[node_range.start] for node_range in node_ranges]
+    # tokens of the pieces, which can differ from those of the SBT at the boundaries of the pieces
+    total = offsets[-1]
+
+    def make_empty(node: ast.AST) -> ast.AST:
+      if isinstance(node, ast.Dict):
+        return ast.Dict(keys=[], values=[])
+      return type(node)(**{field: None for field in node._fields})
+
+    def cost_of(node: Optional[ast.AST]) -> int:
+      if node is None:
+        return 0
+      sbt_type = _SBT_TYPES.get(type(node)) or _make_sbt_type(type(node))
+      cost = count_piece(sbt_type.opening_token) + count_piece(sbt_type.closing_token)
+      if isinstance(node, ast.Constant):
+        cost += count_piece(f'_{node.value}')
+      return cost
+
+    elided = [
+      i for i, node_range in enumerate(node_ranges)
+      if isinstance(node_range.node, ast.Constant) and isinstance(node_range.node.value, (str, bytes))
+    ]
+    collapsed = [i for i, node_range in enumerate(node_ranges) if node_range.has_children]
+    dropped = [i for i, node_range in enumerate(node_ranges) if node_range.parent is None]
+    # replacements of the nodes, in the order they are tried
+    candidates = [
+      *((i, ast.Constant(value='...')) for i in sorted(elided, key=lambda i: -costs[i])),
+      *((i, make_empty(node_ranges[i].node)) for i in sorted(
+        collapsed, key=lambda i: (-node_ranges[i].depth, -costs[i]),
+      )),
+      *((i, None) for i in reversed(dropped)),
+    ]
+
+    # by index in `node_ranges` rather than by node, as some nodes, e.g. `ast.Load()`, are shared
+    replacements: Dict[int, Optional[ast.AST]] = {}
+    subtree_ends = [node_range.subtree_end for node_range in node_ranges]
+    replaced = set()
+    target = max_tokens
+    next_candidate = 0
+    while num_tokens > max_tokens and next_candidate < len(candidates):
+      while total > target and next_candidate < len(candidates):
+        i, replacement = candidates[next_candidate]
+        next_candidate += 1
+        ancestor = node_ranges[i].parent
+        while ancestor is not None and ancestor not in replaced:
+          ancestor = node_ranges[ancestor].parent
+        if ancestor is not None:
+          # already gone along with the replaced ancestor
+          continue
+
+        saved = costs[i] - cost_of(replacement)
+        if saved <= 0:
+          continue
+        replacements[i] = replacement
+        replaced.add(i)
+        total -= saved
+        ancestor = i
+        while ancestor is not None:
+          costs[ancestor] -= saved
+          ancestor = node_ranges[ancestor].parent
+
+      sbt = ''.join(cls._serialize(nodes, None, replacements=replacements, subtree_ends=subtree_ends))
+      num_tokens = count_tokens(sbt)
+      # make up for the tokens that the pieces miscounted
+      target -= max(num_tokens - max_tokens, 0)
+
+    return sbt
+
+  @classmethod
+  def _serialize(
+      cls, nodes: RecursiveStmts, indent: Optional[int], level=0,
+      replacements: Optional[Dict[int, Optional[ast.AST]]] = None,
+      subtree_ends: Optional[List[int]] = None,
+      node_ranges: Optional[List['_NodeRange']] = None,
+  ) -> List[str]:
+    """
+    The pieces of the SBT of `nodes`. With `node_ranges`, the pieces of every node are
+    recorded in it. With `replacements`, the node of every index of `node_ranges` that
+    has a replacement is serialized as it instead, or skipped if it is `None`, along
+    with its descendants up to its index in `subtree_ends`. Replacements must have no
+    child nodes.
+    """
+    # Iterative version of serializing recursively, with a stack of frames instead
+    # of recursion. Every frame is a list of nodes that the recursive version would
+    # serialize into its own string, so `frame_start` is where that string starts.
+    # `range_index` is the index in `node_ranges` of the node of the frame, or else
+    # of its closest ancestor.
+    tokens: List[str] = []
+    append_token = tokens.append
+    # the index in `node_ranges` of the next node
+    position = 0
+    stack = [(iter(nodes), level, 0, None, None)]
+    while stack:
+      frame_nodes, frame_level, frame_start, closing_token, range_index = stack[-1]
+      for node in frame_nodes:
+        if isinstance(node, list):
+          stack.append((iter(node), frame_level + 1, len(tokens), None, range_index))
+          break
+
+        if isinstance(node, ast.AST):
+          if replacements:
+            if position in replacements:
+              node = replacements[position]
+              position = subtree_ends[position]
+              if node is None:
+                continue
+            else:
+              position += 1
+          node_type = type(node)
+          sbt_type = _SBT_TYPES.get(node_type) or _make_sbt_type(node_type)
+          children = [
+            child for child in map(node.__getattribute__, sbt_type.fields)
+            if child is not None
+          ]
+          if sbt_type.is_dict:
+            assert len(children) == 2
+            children = [list(pair) for pair in zip(children[0], children[1])]
+          if indent:
+            append_token(_make_indent(frame_level, indent))
+          node_range_index = None
+          if node_ranges is not None:
+            if range_index is not None:
+              node_ranges[range_index].has_children = True
+            node_range_index = len(node_ranges)
+            node_ranges.append(_NodeRange(node, frame_level, range_index, len(tokens)))
+          append_token(sbt_type.opening_token)
+          stack.append((iter(children), frame_level + 1, len(tokens), sbt_type.closing_token, node_range_index))
+          break
 
-      else:
         # Otherwise, `node` is a primitive. To best of my knowledge, in this
         # branch `node` only can can be a string containing a field-name.
-        if bracketed_notation.endswith(')Name'):
-          # for nested object access (e.g. `p1.field`), this `else` branch
+        if len(tokens) > frame_start and tokens[-1].endswith(')Name'):
+          # for nested object access (e.g. `p1.field`), this branch
           # creates strings like "(Name_p1)Name_field". To overcome this,
           # remove last five characters.
-          bracketed_notation = bracketed_notation[:-5]
-        bracketed_notation += f'_{node}'
+          tokens[-1] = tokens[-1][:-5]
+        append_token(f'_{node}')
+      else:
+        # every node of the frame is serialized
+        stack.pop()
+        if closing_token is not None:
+          append_token(closing_token)
+          if node_ranges is not None:
+            node_ranges[range_index].end = len(tokens)
+            node_ranges[range_index].subtree_end = len(node_ranges)
 
-    return bracketed_notation
+    return tokens
 
   @staticmethod
   def get_patched_file_from_patch(patch: Union[PatchSet, str]) -> PatchedFile:
@@ -124,14 +374,29 @@ class StructureSuperImposer:
 
   @staticmethod
   def from_source_code(source_code: str, start: int, end: int):
+    [structure_superimposer] = StructureSuperImposer.from_source_code_spans(source_code, [(start, end)])
+    return structure_superimposer
+
+  @staticmethod
+  def from_source_code_spans(
+      source_code: str, spans: List[Tuple[int, int]],
+  ) -> List['StructureSuperImposer']:
+    """One `StructureSuperImposer` per (start, end) span, parsing the source once."""
     source_tree = StructureSuperImposer.parse_ast_with_async_await_check(source_code)
-    intersecting_nodes = [
-      StructureSuperImposer._get_intersecting_nodes(child, start, end)
-      for i, child in enumerate(source_tree.body)
-      if StructureSuperImposer._has_intersection(child, start, end)
-    ]
+    return StructureSuperImposer.from_tree_spans(source_tree, spans)
 
-    return StructureSuperImposer(intersecting_nodes, [])
+  @staticmethod
+  def from_tree_spans(
+      source_tree: ast.Module, spans: List[Tuple[int, int]],
+  ) -> List['StructureSuperImposer']:
+    """Like `from_source_code_spans`, with a source that is already parsed."""
+    return [
+      StructureSuperImposer([
+        StructureSuperImposer._get_intersecting_nodes(child, start, end)
+        for child in StructureSuperImposer._get_intersecting_statements(source_tree, start, end)
+      ], [])
+      for start, end in spans
+    ]
 
   @staticmethod
   def from_filenames(filename1: str, filename2: str):
@@ -175,37 +440,78 @@ class StructureSuperImposer:
 
       raise AstParseError from e
 
-    intersecting_source_nodes = []
-    intersecting_target_nodes = []
+    hunk_superimposers = StructureSuperImposer._superimpose_hunks(
+      patched_file, prev_tree, target_tree, reverse,
+    )
+    return StructureSuperImposer(
+      [node for superimposer in hunk_superimposers for node in superimposer.source_nodes],
+      [node for superimposer in hunk_superimposers for node in superimposer.target_nodes],
+    )
+
+  @staticmethod
+  def from_diff_hunks(prev_source: str, diff: str, reverse=False) -> List['StructureSuperImposer']:
+    """
+    One `StructureSuperImposer` per hunk of the diff, parsing the previous and
+    the target sources once. `from_diff` is the concatenation of these.
+    """
+    patched_file = StructureSuperImposer.get_patched_file_from_patch(PatchSet(diff))
+    try:
+      prev_tree = StructureSuperImposer.parse_ast_with_async_await_check(
+        prev_source, filename=patched_file.source_file,
+      )
+      target = StructureSuperImposer._make_target_source(prev_source, patched_file, reverse)
+      target_tree = StructureSuperImposer.parse_ast_with_async_await_check(
+        target, filename=patched_file.target_file,
+      )
+    except SyntaxError as e:
+      raise AstParseError from e
+
+    return StructureSuperImposer._superimpose_hunks(patched_file, prev_tree, target_tree, reverse)
+
+  @staticmethod
+  def _superimpose_hunks(
+      patched_file: PatchedFile, prev_tree: ast.Module, target_tree: ast.Module, reverse: bool,
+  ) -> List['StructureSuperImposer']:
+    hunk_superimposers = []
     hunk: Hunk
     for hunk in patched_file:
       prev_start = hunk.source_start
       prev_end = hunk.source_start + hunk.source_length
-      intersecting_source_nodes.extend(
+      intersecting_source_nodes = [
         StructureSuperImposer._get_intersecting_nodes(child, prev_start, prev_end)
-        for i, child in enumerate(prev_tree.body)
-        if StructureSuperImposer._has_intersection(child, prev_start, prev_end)
-      )
+        for child in StructureSuperImposer._get_intersecting_statements(prev_tree, prev_start, prev_end)
+      ]
 
       target_start = hunk.target_start
       target_end = hunk.target_start + hunk.target_length
-      intersecting_target_nodes.extend(
+      intersecting_target_nodes = [
         StructureSuperImposer._get_intersecting_nodes(child, target_start, target_end)
-        for child in target_tree.body
-        if StructureSuperImposer._has_intersection(child, target_start, target_end)
-      )
+        for child in StructureSuperImposer._get_intersecting_statements(target_tree, target_start, target_end)
+      ]
 
-    if reverse:
-      return StructureSuperImposer(
-        intersecting_target_nodes, intersecting_source_nodes,
-      )
+      if reverse:
+        hunk_superimposers.append(StructureSuperImposer(
+          intersecting_target_nodes, intersecting_source_nodes,
+        ))
+      else:
+        hunk_superimposers.append(StructureSuperImposer(
+          intersecting_source_nodes, intersecting_target_nodes,
+        ))
 
-    return StructureSuperImposer(
-      intersecting_source_nodes, intersecting_target_nodes,
-    )
+    return hunk_superimposers
+
+  @staticmethod
+  def parse_ast_with_async_await_check(source: str, filename: str = '<unknown>') -> ast.Module:
+    """
+    Parse `source`, or return its cached tree if it has been parsed recently.
+    The returned tree may be shared with other callers, so it must not be mutated.
+    """
+    if not StructureSuperImposer.PARSED_TREE_CACHE_SIZE:
+      return StructureSuperImposer._parse_ast_with_async_await_check(source, filename)
+    return _parsed_tree_cache.parse(source, filename, StructureSuperImposer.PARSED_TREE_CACHE_SIZE)
 
   @staticmethod
-  def parse_ast_with_async_await_check(source: str, filename: str = '<unknown>'):
+  def _parse_ast_with_async_await_check(source: str, filename: str) -> ast.Module:
     try:
       return ast.parse(source, type_comments=True, filename=filename)
     except SyntaxError as _e:
@@ -215,8 +521,35 @@ class StructureSuperImposer:
 
       raise
 
+  @staticmethod
+  def _get_intersecting_statements(tree: ast.Module, start: int, end: int) -> List[ast.stmt]:
+    """
+    The top-level statements of `tree` that `_has_intersection` with the range.
+    Statements follow one another, so both their start and end lines are sorted,
+    and the intersecting ones are a slice that is found by bisection.
+    """
+    index = _statement_indexes.get(tree)
+    if index is None:
+      index = _StatementIndex(
+        [statement.lineno for statement in tree.body],
+        [statement.end_lineno for statement in tree.body],
+      )
+      _statement_indexes[tree] = index
+
+    # the first statement that ends at or after `start`,
+    # till the last statement that starts at or before `end`
+    return tree.body[bisect_left(index.end_linenos, start): bisect_right(index.linenos, end)]
+
   @staticmethod
   def _is_unit_type(node) -> bool:
+    node_type = type(node)
+    is_unit_type = _UNIT_TYPES.get(node_type)
+    if is_unit_type is None:
+      is_unit_type = _UNIT_TYPES[node_type] = StructureSuperImposer._is_unit_node_type(node)
+    return is_unit_type
+
+  @staticmethod
+  def _is_unit_node_type(node) -> bool:
     if isinstance(node, ast.Call):
       # if it is a function call, consider everything as context
       return True
@@ -278,6 +611,10 @@ class StructureSuperImposer:
   def _get_intersecting_nodes(
       node: Node, start: int, end: int,
   ) -> RecursiveStmts:
+    """
+    The parts of `node` that intersect the range. `node` may belong to a cached,
+    shared tree, so partially intersecting nodes are copied rather than modified.
+    """
     assert type(node) is not ast.Module
 
     if StructureSuperImposer._is_unit_type(node):
@@ -383,26 +720,27 @@ class StructureSuperImposer:
       return target_line[1: end_i]
 
     lines = _prev_source.split('\n')
-    # python lists are 0-indexed, but line numbers are 1-indexed.
-    # Also, if lengths of a `_hunk.source` and a `_hunk.target` are
-    # different they will affect the indexing of the latter replacements.
-    # `offset` fixes these issues.
-    offset = -1
+    # Build the target in a new list rather than replacing the lines in place,
+    # which would shift all the following lines for every hunk. Hunks are
+    # ordered, so copy the unchanged lines till each hunk and then its lines.
+    target_lines = []
+    # number of lines of `lines` that are copied or replaced so far
+    num_consumed = 0
     _hunk: Hunk
     for _hunk in file_patch:
       _start = _hunk.target_start if reverse else _hunk.source_start
       _length = _hunk.target_length if reverse else _hunk.source_length
-      _end = _start + _length
-      changed_lines = list(map(
+      # python lists are 0-indexed, but line numbers are 1-indexed. A hunk
+      # without lines to replace starts *after* its line number instead.
+      _start_i = _start if _length == 0 else _start - 1
+      target_lines.extend(lines[num_consumed: _start_i])
+      target_lines.extend(map(
         trim_whitespace, _hunk.source if reverse else _hunk.target,
       ))
+      num_consumed = _start_i + _length
 
-      lines[_start + offset: _end + offset] = changed_lines
-
-      num_former_lines = _end - _start
-      offset += (len(changed_lines) - num_former_lines)
-
-    return '\n'.join(lines)
+    target_lines.extend(lines[num_consumed:])
+    return '\n'.join(target_lines)
 
   @staticmethod
   def _reorder_dict_children(_dict: ast.Dict):
@@ -450,6 +788,7 @@ StructureSuperImposer.COMPREHENSION_TYPES = (
 )
 StructureSuperImposer.USE_AST_UNPARSE_REPR = True
 StructureSuperImposer.USE_TARGET_CODE_IN_REPR = True
+StructureSuperImposer.PARSED_TREE_CACHE_SIZE = 64
 
 
 def assert_version():
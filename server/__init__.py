@@ -1,25 +1,82 @@
 import json
 import os.path
+import queue
+import threading
 import uuid
 from dataclasses import dataclass, asdict
-from time import time
-from typing import Dict, Optional, List
+from functools import partial, lru_cache
+from time import time, perf_counter
+from typing import Dict, Optional, List, Tuple, TYPE_CHECKING
 
-import pandas as pd
-import torch
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, Response, abort, stream_with_context
 from flask_cors import CORS
-from torch.nn import functional as F
-from transformers import T5Config, T5ForConditionalGeneration, RobertaTokenizer
+from unidiff import PatchSet, UnidiffParseError
 from werkzeug.exceptions import HTTPException
 
-from .Bugsplainer import Bugsplainer
+from .Bugsplainer import (
+    Bugsplainer, DecodingProfile, DECODING_PROFILES, DEFAULT_PROFILE, get_sbt_token_budget, get_tokenizer,
+)
+from .DocumentStore import DocumentStore, Document
+from .ExperimentalDataset import open_experimental_dataset, MAPPED_EXTENSION
+from .ExplanationCache import InMemoryExplanationCache, SqliteExplanationCache, make_cache_key
+from .JobQueue import JobQueue
+from .JsonResponse import jsonify
+from .Metrics import metrics, render, Gauge, SharedMetrics, REQUEST_SECONDS, STAGE_SECONDS
+from .ModelRegistry import ModelRegistry
+from .ModelServer import RemoteModelRegistry
+from .SbtPool import SbtPool, make_error_record
+from .StructureSuperimposer import StructureSuperImposer
+
+if TYPE_CHECKING:
+    from .InferenceBackend import BackendConfig
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Request-Id'])
 
 MODEL_DIR = 'server/models'
-device = torch.device('cuda')
+# tokens of a model input, and the prefix of the inputs of the models that explain SBTs
+MAX_SOURCE_LENGTH = 512
+SBT_PREFIX = 'finetune sbt-random: '
+# inputs from concurrent `/explain` requests are explained together in one
+# `generate` call of up to MAX_BATCH_SIZE inputs, waiting at most MAX_WAIT_MS
+MAX_BATCH_SIZE = int(os.environ.get('BUGSPLAINER_MAX_BATCH_SIZE', 8))
+MAX_WAIT_MS = float(os.environ.get('BUGSPLAINER_MAX_WAIT_MS', 10))
+# inputs are padded up to the smallest of these lengths that fits the longest
+# input of the batch, rather than always to 512. Set it empty to pad exactly.
+PADDING_BUCKETS = [
+    int(bucket) for bucket in
+    os.environ.get('BUGSPLAINER_PADDING_BUCKETS', '64,128,256,512').split(',')
+    if bucket.strip()
+]
+# when set, least recently used models are unloaded to keep the loaded ones within the budget
+MODEL_MEMORY_BUDGET_MB = os.environ.get('BUGSPLAINER_MODEL_MEMORY_BUDGET_MB')
+# `BackendConfig` of each model by its name, e.g. '{"Bugsplainer 220M": {"device": "cpu", "bf16": true}}'.
+# Models that are not listed run on CUDA if it is available, and on CPU otherwise.
+MODEL_BACKENDS: Dict[str, Dict] = json.loads(os.environ.get('BUGSPLAINER_MODEL_BACKENDS', '{}'))
+# explanations are cached in memory, or in an SQLite file shared by all the workers if its path is set
+EXPLANATION_CACHE_PATH = os.environ.get('BUGSPLAINER_EXPLANATION_CACHE_PATH')
+EXPLANATION_CACHE_SIZE = int(os.environ.get('BUGSPLAINER_EXPLANATION_CACHE_SIZE', 4096))
+EXPLANATION_CACHE_TTL = float(os.environ.get('BUGSPLAINER_EXPLANATION_CACHE_TTL', 24 * 60 * 60))
+JOB_DIR = os.environ.get('BUGSPLAINER_JOB_DIR', 'data/jobs')
+JOB_BATCH_SIZE = int(os.environ.get('BUGSPLAINER_JOB_BATCH_SIZE', 32))
+JOB_TTL = float(os.environ.get('BUGSPLAINER_JOB_TTL', 24 * 60 * 60))
+# processes that build the SBTs of jobs. With 1, they are built by the thread running the job.
+SBT_PROCESSES = int(os.environ.get('BUGSPLAINER_SBT_PROCESSES', 1))
+# encoder hidden states of recent inputs kept by each model, to decode them again without encoding
+ENCODER_CACHE_SIZE = int(os.environ.get('BUGSPLAINER_ENCODER_CACHE_SIZE', 32))
+# Unix socket of a `python -m server.ModelServer` process. When set, this process
+# loads no models and has them explained by the model server instead.
+MODEL_SERVER_ADDRESS = os.environ.get('BUGSPLAINER_MODEL_SERVER')
+# load the models in the background once the server starts, rather than on their first request
+WARM_UP = os.environ.get('BUGSPLAINER_WARM_UP', '1') != '0'
+# documents edited through `/explain/document` that are kept by each server process
+DOCUMENT_STORE_SIZE = int(os.environ.get('BUGSPLAINER_DOCUMENT_STORE_SIZE', 256))
+# SBTs are shrunk to this many tokens, rather than cut off by the tokenizer. By default,
+# to what fits in a model input along with the prefix. `0` leaves them as they are.
+SBT_MAX_TOKENS = os.environ.get('BUGSPLAINER_SBT_MAX_TOKENS')
+# directory where each worker writes its metrics, so that `/metrics` of any worker reports
+# those of all of them. Unset, `/metrics` reports the worker that serves it.
+METRICS_DIR = os.environ.get('BUGSPLAINER_METRICS_DIR')
 
 
 @dataclass
@@ -42,30 +99,201 @@ class ModelNames:
 
 
 model_names = ModelNames()
+MODEL_NAMES = [model_data['name'] for model_data in asdict(model_names).values()]
 
 
-def create_model_from_data(_model_data):
+def _get_model_prefix(model: str) -> str:
+    # FineTuned CodeT5 is fine-tuned on the code itself rather than its SBT
+    return 'finetune patch: ' if model == model_names.FineTunedCodeT5.name else SBT_PREFIX
+
+
+def create_model_from_data(_model_data, backend_config: Optional['BackendConfig'] = None):
+    # imports torch, so only when the first model is loaded
+    from .InferenceBackend import InferenceBackend, BackendConfig
+
     config_path = os.path.join(
         MODEL_DIR,
         'config_220m.json' if _model_data['name'] == model_names.Bugsplainer220M.name else 'config_60m.json',
     )
-    model_path = os.path.join(
-        MODEL_DIR, _model_data['file'], 'output', 'checkpoint-best-bleu',
+    model_path = _get_model_path(_model_data)
+    prefix = _get_model_prefix(_model_data['name'])
+    backend = InferenceBackend(backend_config or BackendConfig(**MODEL_BACKENDS.get(_model_data['name'], {})))
+    return Bugsplainer(
+        max_length=MAX_SOURCE_LENGTH, config_path=config_path, model_path=model_path, padding_buckets=PADDING_BUCKETS, prefix=prefix,
+        encoder_cache_size=ENCODER_CACHE_SIZE,
+        backend=backend,
+        name=_model_data['name'],
+    )
+
+
+def _get_model_path(_model_data) -> str:
+    return os.path.join(MODEL_DIR, _model_data['file'], 'output', 'checkpoint-best-bleu')
+
+
+def estimate_model_size(_model_data) -> int:
+    """Bytes of the checkpoint of the model, about what its weights take in memory, without loading it."""
+    model_path = _get_model_path(_model_data)
+    checkpoints = ['pytorch_model.bin']
+    if MODEL_BACKENDS.get(_model_data['name'], {}).get('int8'):
+        # the checkpoint saved by `server.Quantization`, if any
+        checkpoints.insert(0, 'pytorch_model.int8.bin')
+    for checkpoint in checkpoints:
+        checkpoint_path = os.path.join(model_path, checkpoint)
+        if os.path.exists(checkpoint_path):
+            return os.path.getsize(checkpoint_path)
+    return 0
+
+
+if MODEL_SERVER_ADDRESS:
+    model_registry = RemoteModelRegistry(MODEL_SERVER_ADDRESS)
+else:
+    model_registry = ModelRegistry(
+        {
+            model_data['name']: partial(create_model_from_data, model_data)
+            for model_data in asdict(model_names).values()
+        },
+        memory_budget=MODEL_MEMORY_BUDGET_MB and int(MODEL_MEMORY_BUDGET_MB) * 1024 * 1024,
+        size_estimators={
+            model_data['name']: partial(estimate_model_size, model_data)
+            for model_data in asdict(model_names).values()
+        },
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=MAX_WAIT_MS,
+    )
+
+# models that are loaded by the warm-up, and that `/ready` waits for
+WARM_UP_MODELS = [
+    model_data['name'] for model_data in asdict(model_names).values()
+    if model_data['name'] != model_names.FineTunedCodeT5.name
+]
+
+
+def _warm_up():
+    for name in WARM_UP_MODELS:
+        try:
+            model_registry.get(name)
+        except Exception as e:
+            app.logger.error('Could not load %s: %s', name, e)
+
+
+sbt_pool = SbtPool(SBT_PROCESSES)
+# before the warm-up, job queue and batch scheduler threads are started
+sbt_pool.start()
+
+if WARM_UP and not MODEL_SERVER_ADDRESS:
+    threading.Thread(target=_warm_up, name='WarmUp', daemon=True).start()
+
+if EXPLANATION_CACHE_PATH:
+    explanation_cache = SqliteExplanationCache(
+        EXPLANATION_CACHE_PATH, max_size=EXPLANATION_CACHE_SIZE, ttl=EXPLANATION_CACHE_TTL,
     )
-    return Bugsplainer(max_length=512, config_path=config_path, model_path=model_path)
+else:
+    explanation_cache = InMemoryExplanationCache(max_size=EXPLANATION_CACHE_SIZE, ttl=EXPLANATION_CACHE_TTL)
+
+# prefer the memory-mapped copy of the test set, if it has been converted
+EXPERIMENTAL_DATASET_PATH = './data/test-sbt-random-finetune' + (
+    MAPPED_EXTENSION if os.path.exists('./data/test-sbt-random-finetune' + MAPPED_EXTENSION) else '.csv'
+)
+experimental_dataset = open_experimental_dataset(EXPERIMENTAL_DATASET_PATH)
 
+# latency and BLEU of every decoding profile, as measured by `python -m benchmarks.profiles`
+DECODING_PROFILE_REPORT_PATH = './data/decoding-profiles.json'
+decoding_profile_report: Dict[str, Dict] = {}
+if os.path.exists(DECODING_PROFILE_REPORT_PATH):
+    with open(DECODING_PROFILE_REPORT_PATH) as report_file:
+        decoding_profile_report = json.load(report_file)['profiles']
 
-models = {}
-for model_data in asdict(model_names).values():
-    if model_data['name'] == model_names.FineTunedCodeT5.name:
-        continue
-    models[model_data['name']] = create_model_from_data(model_data)
+job_queue = JobQueue(
+    JOB_DIR,
+    make_model_inputs=lambda items: _make_job_model_inputs(items),
+    explain_batch=lambda model, sources, num_explanations: _explain_job_batch(model, sources, num_explanations),
+    batch_size=JOB_BATCH_SIZE,
+    ttl=JOB_TTL,
+)
+
+document_store = DocumentStore(max_size=DOCUMENT_STORE_SIZE)
+
+shared_metrics = SharedMetrics(METRICS_DIR, metrics, gauges=lambda: _get_worker_gauges()) if METRICS_DIR else None
 
 
 @app.route('/models', methods=['GET'])
 def get_model_names():
-    _model_names = [model['name'] for model in asdict(model_names).values()]
-    return jsonify(models=_model_names)
+    profiles = {
+        name: {
+            **profile._asdict(),
+            'max_explanations': profile.max_explanations,
+            'measured': decoding_profile_report.get(name),
+        }
+        for name, profile in DECODING_PROFILES.items()
+    }
+    return jsonify(models=MODEL_NAMES, profiles=profiles, default_profile=DEFAULT_PROFILE)
+
+
+@app.route('/ready', methods=['GET'])
+def get_readiness():
+    """
+    The load state of every model. Responds with 503 until the warmed up models are
+    loaded; without warm-up, models are loaded on their first request instead.
+    """
+    try:
+        load_states = model_registry.load_states()
+    except (EOFError, OSError) as e:
+        # the model server is not up yet
+        return jsonify(ready=False, message=repr(e)), 503
+
+    ready = not WARM_UP or all(load_states[name] == 'loaded' for name in WARM_UP_MODELS)
+    return jsonify(ready=ready, models=load_states), 200 if ready else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Latency histograms, queue depth, cache stats and model memory, in the Prometheus text format."""
+    if shared_metrics is not None:
+        snapshots, worker_gauges = shared_metrics.read()
+    else:
+        snapshots, worker_gauges = [metrics.snapshot()], _get_worker_gauges()
+    if MODEL_SERVER_ADDRESS:
+        # the models run in the model server, and so are timed there
+        snapshots.append(model_registry.metrics_snapshot())
+
+    gauges = [*worker_gauges]
+    # the model server and the SQLite cache are shared by the workers, so only reported once
+    if MODEL_SERVER_ADDRESS:
+        gauges.extend(_make_model_gauges())
+    if EXPLANATION_CACHE_PATH:
+        gauges.append(_make_cache_gauge())
+    return Response(render(snapshots, gauges), mimetype='text/plain; version=0.0.4')
+
+
+def _get_worker_gauges() -> List[Gauge]:
+    """The gauges of what each worker has of its own, which are summed over the workers."""
+    gauges = [Gauge('bugsplainer_job_queue_depth', 'Jobs waiting to run', (), {(): job_queue.qsize()})]
+    if not MODEL_SERVER_ADDRESS:
+        gauges.extend(_make_model_gauges())
+    if not EXPLANATION_CACHE_PATH:
+        gauges.append(_make_cache_gauge())
+    return gauges
+
+
+def _make_model_gauges() -> List[Gauge]:
+    model_stats = model_registry.stats()
+    return [
+        Gauge(
+            'bugsplainer_queue_depth', 'Inputs waiting for a batch of each loaded model', ('model',),
+            {(name, ): stats['queue_depth'] for name, stats in model_stats.items()},
+        ),
+        Gauge(
+            'bugsplainer_model_memory_bytes', 'Memory of the parameters and buffers of each loaded model', ('model',),
+            {(name, ): stats['memory_bytes'] for name, stats in model_stats.items()},
+        ),
+    ]
+
+
+def _make_cache_gauge() -> Gauge:
+    return Gauge(
+        'bugsplainer_explanation_cache', 'Hits, misses and size of the explanation cache', ('stat',),
+        {(stat, ): value for stat, value in explanation_cache.stats().items()},
+    )
 
 
 @app.route('/explain', methods=['POST'])
@@ -76,57 +304,258 @@ def explain():
     end = request_data.get('end')
     model = request_data.get('model')
     num_explanations = request_data.get('num_explanations')
+    profile = DECODING_PROFILES.get(request_data.get('profile') or DEFAULT_PROFILE)
+    if profile is None:
+        return _make_unknown_profile_response(request_data.get('profile'))
 
     if model == model_names.FineTunedCodeT5.name:
         explanations = _get_explanations_from_fine_tuned_CodeT5(
-            code, start, end, num_explanations
+            code, start, end, model=model, num_explanations=num_explanations, profile=profile,
         )
     else:
         try:
             explanations = _get_explanations_from_Bugsplainer(
                 code, start, end,
-                model=models[model],
+                model=model,
                 num_explanations=num_explanations,
+                profile=profile,
             )
         except SyntaxError as syntax_error:
-            return {
-                'error': True,
-                'type': SyntaxError.__name__,
-                'line': syntax_error.lineno,
-                'col': syntax_error.offset,
-                'text': syntax_error.text,
-            }, 400
+            return _make_syntax_error_response(syntax_error)
 
     return jsonify(model=model, explanations=explanations)
 
 
+@app.route('/explain/stream', methods=['POST'])
+def explain_stream():
+    """
+    Same as `/explain`, but responds with server-sent events. An `input` event with
+    the model input (e.g. SBT) and its number of tokens is sent right away, then
+    `hypotheses` events while beam search runs, and the `explanations` event at the end.
+    """
+    request_data: Dict = request.json
+    code = request_data.get('code')
+    start = request_data.get('start')
+    end = request_data.get('end')
+    model = request_data.get('model')
+    num_explanations = request_data.get('num_explanations') or 3
+    profile = DECODING_PROFILES.get(request_data.get('profile') or DEFAULT_PROFILE)
+    if profile is None:
+        return _make_unknown_profile_response(request_data.get('profile'))
+    # once streaming, errors can only be sent as events
+    if model not in MODEL_NAMES:
+        return _make_unknown_model_response(model)
+
+    try:
+        model_input = _make_model_input(code, start, end, model)
+    except SyntaxError as syntax_error:
+        return _make_syntax_error_response(syntax_error)
+
+    return Response(
+        stream_with_context(_stream_explanations(model, model_input, num_explanations, profile)),
+        mimetype='text/event-stream',
+        # stop nginx from buffering the events
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route('/explain/batch', methods=['POST'])
+def explain_batch():
+    """
+    Explain several `ranges` ({start, end}) of one `code`. The code is parsed once
+    and all the ranges are explained with a single batched generation.
+    """
+    request_data: Dict = request.json
+    code = request_data.get('code')
+    ranges = request_data.get('ranges')
+    model = request_data.get('model')
+    num_explanations = request_data.get('num_explanations') or 3
+    profile = DECODING_PROFILES.get(request_data.get('profile') or DEFAULT_PROFILE)
+    if profile is None:
+        return _make_unknown_profile_response(request_data.get('profile'))
+    if not isinstance(ranges, list) or not all(
+            isinstance(_range, dict) and {'start', 'end'} <= _range.keys() for _range in ranges
+    ):
+        return jsonify(message='`ranges` must be a list of {start, end}'), 400
+
+    try:
+        model_inputs = _make_model_inputs(code, [(_range['start'], _range['end']) for _range in ranges], model)
+    except SyntaxError as syntax_error:
+        return _make_syntax_error_response(syntax_error)
+
+    explanations = _explain_many(model, model_inputs, num_explanations, profile)
+    return jsonify(model=model, explanations=[
+        {
+            'start': _range['start'],
+            'end': _range['end'],
+            'explanations': [
+                Explanation(*param) for param in zip(explanation.explanations, explanation.scores)
+            ],
+        }
+        for _range, explanation in zip(ranges, explanations)
+    ])
+
+
+@app.route('/explain/diff', methods=['POST'])
+def explain_diff():
+    """
+    Explain a unified `diff` of the previous `source`. Diffs that the model reads
+    whole are explained at once; larger ones are explained hunk by hunk, in a
+    single batched generation. Each explanation lists the `hunks` it covers.
+    """
+    request_data: Dict = request.json
+    source = request_data.get('source')
+    diff = request_data.get('diff')
+    model = request_data.get('model')
+    num_explanations = request_data.get('num_explanations') or 3
+    profile = DECODING_PROFILES.get(request_data.get('profile') or DEFAULT_PROFILE)
+    if profile is None:
+        return _make_unknown_profile_response(request_data.get('profile'))
+    if model not in MODEL_NAMES:
+        return _make_unknown_model_response(model)
+    if model == model_names.FineTunedCodeT5.name:
+        return jsonify(message=f'{model} cannot explain diffs'), 400
+    if not isinstance(source, str) or not isinstance(diff, str):
+        return jsonify(message='`source` and `diff` must be strings'), 400
+
+    try:
+        patch = PatchSet(diff)
+    except UnidiffParseError as e:
+        return jsonify(message=f'Invalid diff: {e}'), 400
+    changed_files = [patched_file for patched_file in patch if patched_file.added or patched_file.removed]
+    if not changed_files:
+        return jsonify(message='`diff` does not change any file'), 400
+    # unidiff may split a file whose name has whitespace into an empty file and the changed one
+    if len(patch) > 2 or changed_files != [patch[-1]]:
+        return jsonify(message='`diff` must change a single file, the one of `source`'), 400
+
+    try:
+        if len(diff.split()) <= 100:
+            hunk_groups = [list(range(len(patch[-1])))]
+            model_inputs = [Bugsplainer.make_sbt_from_diff(source, diff, _get_sbt_max_tokens())]
+        else:
+            model_inputs = Bugsplainer.make_sbts_from_diff_hunks(source, diff, _get_sbt_max_tokens())
+            hunk_groups = [[i] for i in range(len(model_inputs))]
+    except SyntaxError as syntax_error:
+        # `AstParseError` keeps the location in the original error
+        return _make_syntax_error_response(syntax_error.__cause__ or syntax_error)
+
+    explanations = _explain_many(model, model_inputs, num_explanations, profile)
+    return jsonify(model=model, explanations=[
+        {
+            'hunks': hunks,
+            'explanations': [
+                Explanation(*param) for param in zip(explanation.explanations, explanation.scores)
+            ],
+        }
+        for hunks, explanation in zip(hunk_groups, explanations)
+    ])
+
+
+@app.route('/explain/document', methods=['POST'])
+def explain_document():
+    """
+    Explain the lines `start` to `end` of a document being edited. The first request
+    of a `document_id` sends its `source`; later ones send only the `edits`
+    ({offset, length, text}) made since the `version` of the previous response.
+    When the model input of the span is the same as in the last explanation of
+    the span, that explanation is returned without generating again.
+    """
+    request_data: Dict = request.json
+    document_id = request_data.get('document_id')
+    start = request_data.get('start')
+    end = request_data.get('end')
+    model = request_data.get('model')
+    num_explanations = request_data.get('num_explanations') or 3
+    if not isinstance(document_id, str) or not document_id:
+        return jsonify(message='`document_id` must be a non-empty string'), 400
+
+    if 'source' in request_data:
+        document = document_store.open(document_id, request_data['source'])
+    else:
+        try:
+            document = document_store.edit(
+                document_id, request_data.get('edits') or [], version=request_data.get('version'),
+            )
+        except ValueError as e:
+            return jsonify(message=str(e)), 400
+        if document is None:
+            # the client has to send the whole source again
+            return jsonify(message=f'Document {document_id} is not open at this version'), 409
+
+    try:
+        model_input = _make_document_input(document, start, end, model)
+    except SyntaxError as syntax_error:
+        return _make_syntax_error_response(syntax_error)
+
+    key = model, start, end, num_explanations
+    explanation = document.get_explanation(key, model_input)
+    unchanged = explanation is not None
+    if not unchanged:
+        explanation = _explain(model, model_input, num_explanations)
+        document.set_explanation(key, model_input, explanation)
+
+    return jsonify(
+        model=model,
+        document_id=document_id,
+        version=document.version,
+        unchanged=unchanged,
+        explanations=[
+            Explanation(*param) for param in zip(explanation.explanations, explanation.scores)
+        ],
+    )
+
+
+@app.route('/explain/cache', methods=['GET'])
+def get_explanation_cache_stats():
+    stats = explanation_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    return jsonify(**stats, hit_rate=stats['hits'] / lookups if lookups else None)
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    items = request.json.get('items')
+    if not isinstance(items, list) or not all(
+            isinstance(item, dict) and {'code', 'start', 'end', 'model'} <= item.keys()
+            for item in items
+    ):
+        return jsonify(message='`items` must be a list of {code, start, end, model}'), 400
+
+    job_id = job_queue.submit(items)
+    return jsonify(job_queue.status(job_id)), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    status = job_queue.status(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def get_job_results(job_id: str):
+    """Results of the job as JSON lines, streamed as they are ready, in order of completion."""
+    if job_queue.status(job_id) is None:
+        abort(404)
+    return Response(stream_with_context(job_queue.results(job_id)), mimetype='application/x-ndjson')
+
+
 @app.route('/experimental/files', methods=['GET'])
 def get_experimental_files():
-    df: pd.DataFrame = pd.read_csv('./data/test-sbt-random-finetune.csv', usecols=['repo', 'path'])
-    filenames: pd.Series = df['repo'].str.replace('.', '/', regex=False) + '/' + df['path']
-    filenames = filenames[filenames.str.len() < 50]
-    return jsonify(files=filenames[-100:].sort_values().tolist())
+    return jsonify(files=experimental_dataset.filenames())
 
 
 @app.route('/experimental/file')
 def get_experimental_file_content():
     filename = request.values['path']
     app.logger.info('filename: %s', filename)
-    df: pd.DataFrame = pd.read_csv(
-        './data/test-sbt-random-finetune.csv',
-        usecols=['repo', 'path', 'commit_message', 'content', 'start', 'end'],
-    )
-    filename_parts = filename.split('/')
-    repo = '.'.join(filename_parts[:2])
-    path = '/'.join(filename_parts[2:])
-    df = df[(df['repo'] == repo) & (df['path'] == path)]
+    experimental_file = experimental_dataset.get(filename)
+    if experimental_file is None:
+        abort(404)
 
-    return jsonify(
-        content=df.iloc[0]['content'],
-        start=df['start'].tolist(),
-        end=df['end'].tolist(),
-        commit_message=df['commit_message'].tolist(),
-    )
+    return jsonify(asdict(experimental_file))
 
 
 def group_recursively(filename_parts: List[List[str]], level=0) -> Dict[str, List]:
@@ -153,79 +582,236 @@ def group_recursively(filename_parts: List[List[str]], level=0) -> Dict[str, Lis
 
 
 def _get_explanations_from_fine_tuned_CodeT5(
-        code: str, start: int, end: int, num_explanations: Optional[int] = None,
+        code: str, start: int, end: int, model: str, num_explanations: Optional[int] = None,
+        profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
 ):
-    tokenizer = RobertaTokenizer.from_pretrained('Salesforce/codet5-base')
-    config = T5Config.from_pretrained(os.path.join(MODEL_DIR, 'config_60m.json'))
-    model_path = os.path.join(
-        MODEL_DIR, ModelNames.FineTunedCodeT5.file, 'output', 'checkpoint-best-bleu',
-    )
-    model: T5ForConditionalGeneration = T5ForConditionalGeneration.from_pretrained(
-        model_path, config=config,
-    )
-    model.to(device)
-    model.eval()
-
-    code_lines = [
-        line for i, line in enumerate(code.splitlines(), 1)
-        if start <= i <= end
+    buggy_code = _make_model_input(code, start, end, model)
+    explanation = _explain(model, buggy_code, num_explanations=num_explanations or 3, profile=profile)
+    return [
+        Explanation(*param) for param in zip(explanation.explanations, explanation.scores)
     ]
 
-    buggy_code = '\n'.join(code_lines)
-    source_str = f"finetune patch: {buggy_code}"
-    source_ids = tokenizer.encode(
-        source_str, max_length=512, padding='max_length', truncation=True,
-    )
-    source_tensor = torch.tensor([source_ids], dtype=torch.long, device=device)
-    source_mask = source_tensor.ne(tokenizer.pad_token_id)
-
-    outputs = model.generate(
-        inputs=source_tensor,
-        attention_mask=source_mask,
-        early_stopping=True,
-        num_beams=10,
-        num_return_sequences=num_explanations or 3,
-        output_scores=True,
-        return_dict_in_generate=True,
-    )
-
-    explanations = [
-        tokenizer.decode(seq, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-        for seq in outputs.sequences
-    ]
 
-    scores = F.softmax(outputs.sequences_scores, dim=0).tolist()
+def _get_explanations_from_Bugsplainer(
+        code: str, start: int, end: int, model: str, num_explanations: Optional[int] = None,
+        profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+):
+    sbt = _make_model_input(code, start, end, model)
+    explanation = _explain(model, sbt, num_explanations=num_explanations or 3, profile=profile)
     return [
-        Explanation(*param) for param in zip(explanations, scores)
+        Explanation(*param) for param in zip(explanation.explanations, explanation.scores)
     ]
 
 
-def _get_explanations_from_Bugsplainer(
-        code: str, start: int, end: int, model: Bugsplainer, num_explanations: Optional[int] = None,
+def _make_model_input(code: str, start: int, end: int, model: str) -> str:
+    [model_input] = _make_model_inputs(code, [(start, end)], model)
+    return model_input
+
+
+@lru_cache(maxsize=None)
+def _get_sbt_max_tokens() -> Optional[int]:
+    # loads the tokenizer, so only when the first SBT is made
+    if SBT_MAX_TOKENS is not None:
+        return int(SBT_MAX_TOKENS) or None
+    return get_sbt_token_budget(MAX_SOURCE_LENGTH, SBT_PREFIX)
+
+
+def _make_job_model_inputs(items: List[Dict]) -> List:
+    """The model input of each item of a job, or the error record of why it has none."""
+    model_inputs = [None] * len(items)
+    sbt_indices = []
+    for i, item in enumerate(items):
+        if item['model'] != model_names.FineTunedCodeT5.name:
+            sbt_indices.append(i)
+            continue
+        try:
+            model_inputs[i] = _make_model_input(item['code'], item['start'], item['end'], item['model'])
+        except Exception as e:
+            model_inputs[i] = make_error_record(e)
+
+    sbts = sbt_pool.make_sbts_from_spans([
+        (items[i]['code'], items[i]['start'], items[i]['end']) for i in sbt_indices
+    ], _get_sbt_max_tokens())
+    for i, sbt in zip(sbt_indices, sbts):
+        model_inputs[i] = sbt
+    return model_inputs
+
+
+def _make_model_inputs(code: str, spans: List[Tuple[int, int]], model: str) -> List[str]:
+    if model == model_names.FineTunedCodeT5.name:
+        lines = code.splitlines()
+        return ['\n'.join(lines[max(start, 1) - 1: max(end, 0)]) for start, end in spans]
+
+    with STAGE_SECONDS.time(model=model, stage='parse'):
+        tree = StructureSuperImposer.parse_ast_with_async_await_check(code)
+    with STAGE_SECONDS.time(model=model, stage='sbt'):
+        max_tokens = _get_sbt_max_tokens()
+        return [Bugsplainer.make_sbt_from_tree_span(tree, start, end, max_tokens) for start, end in spans]
+
+
+def _make_document_input(document: Document, start: int, end: int, model: str) -> str:
+    if model == model_names.FineTunedCodeT5.name:
+        [model_input] = _make_model_inputs(document.source, [(start, end)], model)
+        return model_input
+
+    # the tree is kept with the document, so it is parsed once per version
+    with STAGE_SECONDS.time(model=model, stage='parse'):
+        tree = document.tree()
+    with STAGE_SECONDS.time(model=model, stage='sbt'):
+        return Bugsplainer.make_sbt_from_tree_span(tree, start, end, _get_sbt_max_tokens())
+
+
+def _make_cache_key(model: str, source: str, num_explanations: int, profile: DecodingProfile):
+    return make_cache_key(model, source, num_explanations, early_stopping=True, **profile.generation_params())
+
+
+def _explain(
+        model: str, source: str, num_explanations: int,
+        profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
 ):
-    sbt = Bugsplainer.make_sbt_from_span(code, start, end)
-    explanation = model.explain(sbt, num_explanations=num_explanations or 3)
-    return [
+    # profiles that run fewer beams return fewer explanations
+    num_explanations = min(num_explanations, profile.max_explanations)
+    cache_key = _make_cache_key(model, source, num_explanations, profile)
+    explanation = explanation_cache.get(cache_key)
+    if explanation is None:
+        explanation = model_registry.get(model).explain(source, num_explanations=num_explanations, profile=profile)
+        explanation_cache.set(cache_key, explanation)
+    return explanation
+
+
+def _explain_many(
+        model: str, sources: List[str], num_explanations: int,
+        profile: DecodingProfile = DECODING_PROFILES[DEFAULT_PROFILE],
+):
+    """Explain the sources that are not cached with a single batched generation."""
+    num_explanations = min(num_explanations, profile.max_explanations)
+    cache_keys = [_make_cache_key(model, source, num_explanations, profile) for source in sources]
+    explanations = {cache_key: explanation_cache.get(cache_key) for cache_key in set(cache_keys)}
+    missing_sources = {
+        cache_key: source for cache_key, source in zip(cache_keys, sources)
+        if explanations[cache_key] is None
+    }
+    if missing_sources:
+        with model_registry.use(model) as bugsplainer:
+            generated = bugsplainer.explain_batch(
+                list(missing_sources.values()), [num_explanations] * len(missing_sources), profile=profile,
+            )
+        for cache_key, explanation in zip(missing_sources, generated):
+            explanations[cache_key] = explanation
+            explanation_cache.set(cache_key, explanation)
+
+    return [explanations[cache_key] for cache_key in cache_keys]
+
+
+def _explain_job_batch(model: str, sources: List[str], num_explanations: List[int]) -> List:
+    # the batches of jobs are larger than those of the scheduler
+    with model_registry.use(model) as bugsplainer:
+        return bugsplainer.explain_batch(sources, num_explanations)
+
+
+def _stream_explanations(model: str, source: str, num_explanations: int, profile: DecodingProfile):
+    # counted with the shared tokenizer, so that the input is sent before the model is loaded
+    num_tokens = len(get_tokenizer().encode(
+        f'{_get_model_prefix(model)}{source}', max_length=MAX_SOURCE_LENGTH, truncation=True,
+    ))
+    yield _make_event('input', {'sbt': source, 'num_tokens': num_tokens})
+
+    num_explanations = min(num_explanations, profile.max_explanations)
+    cache_key = _make_cache_key(model, source, num_explanations, profile)
+    explanation = explanation_cache.get(cache_key)
+    if explanation is None:
+        # generate in another thread, so that the hypotheses can be sent while it runs
+        events = queue.Queue()
+
+        def generate():
+            try:
+                # used by this thread, which keeps generating if the client disconnects
+                with model_registry.use(model) as bugsplainer:
+                    [_explanation] = bugsplainer.explain_batch(
+                        [source], [num_explanations],
+                        on_step=lambda hypotheses: events.put(('hypotheses', hypotheses[0])),
+                        profile=profile,
+                    )
+                events.put(('explanation', _explanation))
+            except Exception as e:
+                events.put(('error', e))
+
+        threading.Thread(target=generate, daemon=True).start()
+        last_hypotheses = None
+        while True:
+            event, data = events.get()
+            if event == 'error':
+                app.logger.error('Error: %s', data)
+                yield _make_event('error', {'message': repr(data)})
+                return
+            if event == 'explanation':
+                explanation = data
+                break
+            if data != last_hypotheses:
+                last_hypotheses = data
+                yield _make_event('hypotheses', {'hypotheses': data})
+
+        explanation_cache.set(cache_key, explanation)
+
+    explanations = [
         Explanation(*param) for param in zip(explanation.explanations, explanation.scores)
     ]
+    yield _make_event('explanations', {
+        'model': model,
+        'explanations': [asdict(_explanation) for _explanation in explanations],
+    })
+
+
+def _make_event(event: str, data: Dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def _make_unknown_profile_response(profile: str):
+    return jsonify(message=f'Unknown profile {profile!r}, expected one of {", ".join(DECODING_PROFILES)}'), 400
+
+
+def _make_unknown_model_response(model: str):
+    return jsonify(message=f'Unknown model {model!r}, expected one of {", ".join(MODEL_NAMES)}'), 400
+
+
+def _make_syntax_error_response(syntax_error: SyntaxError):
+    return jsonify(
+        error=True,
+        type=SyntaxError.__name__,
+        line=syntax_error.lineno,
+        col=syntax_error.offset,
+        text=syntax_error.text,
+    ), 400
 
 
 @app.before_request
 def set_req_ids():
     request.environ['id'] = uuid.uuid4()
     request.environ['created'] = time()
+    request.environ['started'] = perf_counter()
+
+
+@app.before_request
+def start_shared_metrics():
+    if shared_metrics is not None:
+        # each gunicorn worker starts writing its metrics on its first request
+        shared_metrics.start()
 
 
 @app.after_request
-def send_req_ids(response: Response):
-    response.data = json.dumps({
-        # in OPTIONS requests, response.json is None
-        **(response.json if response.json else {}),
-        'id': str(request.environ['id']),
-        'created': request.environ['created'],
-        'completed': time(),
-    })
+def record_latency(response: Response):
+    REQUEST_SECONDS.observe(
+        perf_counter() - request.environ['started'],
+        endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+        status=response.status_code,
+    )
+    return response
 
+
+@app.after_request
+def send_req_ids(response: Response):
+    # JSON bodies carry the id too, added by `jsonify`; streamed responses only have the header
+    response.headers['X-Request-Id'] = str(request.environ['id'])
     return response
 
 